@@ -0,0 +1,159 @@
+from __future__ import annotations
+from src.instrument_drivers.AsyncInstrumentConnection import AsyncInstrumentConnection
+from src.instrument_drivers.Instrument import Instrument
+from src.instrument_drivers.DMM6500 import DMM6500
+from src.instrument_drivers.CPX400DP import CPX400DP
+
+"""
+Async counterparts of the instrument drivers
+
+The async variants wrap the blocking driver and execute its methods on the worker
+thread of the AsyncInstrumentConnection, so the command logic stays in one place.
+Several instruments can then be driven at once, e.g.
+
+    volt, amp = await asyncio.gather(voltmeter.acquire_measurement(), ammeter.acquire_measurement())
+"""
+class AsyncInstrument:
+    DRIVER = Instrument
+
+    def __init__(self, connection: AsyncInstrumentConnection, mode = "default", instrument: Instrument = None):
+        self.__connection = connection
+        self.__instrument = self.DRIVER(connection.connection, mode) if instrument is None else instrument
+
+    async def __aenter__(self):
+        if self.__connection.is_open is False:
+            await self.__connection.__aenter__()
+        await self._run(self.__instrument.__enter__)
+        return self
+
+    async def __aexit__(self, except_type, except_val, except_trace):
+        await self._run(self.__instrument.__exit__, except_type, except_val, except_trace)
+
+    @property
+    def _connection(self):
+        return self.__connection
+
+    @property
+    def instrument(self):
+        return self.__instrument
+
+    async def _run(self, func, *args, **kwargs):
+        return await self.__connection.run(func, *args, **kwargs)
+
+    async def get_mode(self):
+        return await self._run(lambda: self.__instrument.mode)
+
+    async def set_mode(self, mode: Instrument.Mode):
+        await self._run(setattr, self.__instrument, "mode", mode)
+
+    async def assert_mode(self, mode: Instrument.Mode):
+        await self._run(self.__instrument.assert_mode, mode)
+
+    async def reset(self):
+        await self._run(self.__instrument.reset)
+
+    async def release(self):
+        await self._run(self.__instrument.release)
+
+    async def stop(self):
+        await self._run(self.__instrument.stop)
+
+class AsyncDMM6500(AsyncInstrument):
+    DRIVER = DMM6500
+
+    async def __call__(self, chan_ref: DMM6500.ChanRef, mode: DMM6500.Mode) -> AsyncDMM6500:
+        channel = await self._run(self.instrument, chan_ref, mode)
+        return AsyncDMM6500(self._connection, instrument = channel)
+
+    async def toggle_dcv_mode(self):
+        await self._run(self.instrument.toggle_dcv_mode)
+
+    async def toggle_dci_mode(self):
+        await self._run(self.instrument.toggle_dci_mode)
+
+    async def toggle_acv_mode(self):
+        await self._run(self.instrument.toggle_acv_mode)
+
+    async def toggle_aci_mode(self):
+        await self._run(self.instrument.toggle_aci_mode)
+
+    async def set_v_range(self, range):
+        await self._run(self.instrument.set_v_range, range)
+
+    async def set_i_range(self, range):
+        await self._run(self.instrument.set_i_range, range)
+
+    async def acquire_measurement(self, flush = None):
+        return await self._run(self.instrument.acquire_measurement, flush)
+
+    async def burst(self, count, nplc = None, interval = 0, timeout = None):
+        return await self._run(self.instrument.burst, count, nplc, interval, timeout)
+
+    async def scan(self, channels: dict, count = 1, interval = 0, timeout = None):
+        return await self._run(self.instrument.scan, channels, count, interval, timeout)
+
+    async def digitize(self, count, sample_rate = 1e6, mode: DMM6500.Mode = DMM6500.Mode.DigitizeVoltage, chunk = 100000, out = None, timeout = None):
+        return await self._run(self.instrument.digitize, count, sample_rate, mode, chunk, out, timeout)
+
+    async def stream(self, capacity = 100000, interval = 0, poll_interval = 100e-3) -> DMM6500.Stream:
+        return await self._run(self.instrument.stream, capacity, interval, poll_interval)
+
+class AsyncCPX400DP(AsyncInstrument):
+    DRIVER = CPX400DP
+
+    async def get_voltage(self, channel):
+        return await self._run(self.instrument.get_voltage, channel)
+
+    async def set_voltage(self, channel, value):
+        await self._run(self.instrument.set_voltage, channel, value)
+
+    async def set_voltages(self, values: dict):
+        await self._run(self.instrument.set_voltages, values)
+
+    async def get_current(self, channel):
+        return await self._run(self.instrument.get_current, channel)
+
+    async def set_current(self, channel, value):
+        await self._run(self.instrument.set_current, channel, value)
+
+    async def out_on(self, channel, blanking_time = None, settle = True, tolerance = None, timeout = None):
+        return await self._run(self.instrument.out_on, channel, blanking_time, settle, tolerance, timeout)
+
+    async def out_off(self, channel, blanking_time = None, settle = True, tolerance = None, timeout = None):
+        return await self._run(self.instrument.out_off, channel, blanking_time, settle, tolerance, timeout)
+
+    async def set_currents(self, values: dict):
+        await self._run(self.instrument.set_currents, values)
+
+    async def outs_on(self, channels = (1, 2), blanking_time = None, settle = True, tolerance = None, timeout = None):
+        return await self._run(self.instrument.outs_on, channels, blanking_time, settle, tolerance, timeout)
+
+    async def outs_off(self, channels = (1, 2), blanking_time = None, settle = True, tolerance = None, timeout = None):
+        return await self._run(self.instrument.outs_off, channels, blanking_time, settle, tolerance, timeout)
+
+    async def lock(self):
+        return await self._run(self.instrument.lock)
+
+    async def unlock(self):
+        return await self._run(self.instrument.unlock)
+
+    async def read_lim_status_active_bits(self, channel):
+        return await self._run(self.instrument.read_lim_status_active_bits, channel)
+
+    async def read_limits(self, channel):
+        return await self._run(self.instrument.read_limits, channel)
+
+    async def monitor_limits(self, channels = (1, 2), interval = 500e-3, mask = None) -> CPX400DP.LimitMonitor:
+        return await self._run(self.instrument.monitor_limits, channels, interval, mask)
+
+    async def ramp_voltage(self, channel, init_val, final_val, blanking_time = 50e-3, step = 0.1, slew_rate = None):
+        return await self._run(self.instrument.ramp_voltage, channel, init_val, final_val, blanking_time, step, slew_rate)
+
+    async def ramp_voltages(self, init_vals: dict, final_vals: dict, blanking_time = 50e-3, step = 0.1, slew_rate = None):
+        return await self._run(self.instrument.ramp_voltages, init_vals, final_vals, blanking_time, step, slew_rate)
+
+    async def run_ramps(self, channels, ramp):
+        return await self._run(self.instrument.run_ramps, channels, ramp)
+
+    async def run_ramp(self, channel, ramp):
+        return await self._run(self.instrument.run_ramp, channel, ramp)
@@ -0,0 +1,50 @@
+from src.instrument_drivers.InstrumentConnection import InstrumentConnection
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+
+"""
+Asyncio front-end of a blocking InstrumentConnection
+
+Every connection owns a single worker thread, so the traffic of one instrument keeps
+its order while the traffic of different instruments runs concurrently on one
+event loop.
+"""
+class AsyncInstrumentConnection:
+    def __init__(self, connection: InstrumentConnection, executor: ThreadPoolExecutor = None):
+        self.__connection = connection
+        self.__owns_executor = executor is None
+        self.__executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = connection.address) if executor is None else executor
+
+    async def __aenter__(self):
+        await self.run(self.__connection.__enter__)
+        return self
+
+    async def __aexit__(self, except_type, except_val, except_trace):
+        await self.run(self.__connection.__exit__, except_type, except_val, except_trace)
+        self.close()
+
+    @property
+    def connection(self):
+        return self.__connection
+
+    @property
+    def is_open(self):
+        return self.__connection.is_open
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__executor, partial(func, *args, **kwargs))
+
+    async def send(self, cmd, delay = None):
+        await self.run(self.__connection.send, cmd, delay)
+
+    async def send_query(self, query, await_time, delay = None):
+        return await self.run(self.__connection.send_query, query, await_time, delay)
+
+    async def handshake(self):
+        return await self.run(self.__connection.handshake)
+
+    def close(self):
+        if self.__owns_executor:
+            self.__executor.shutdown(wait = False)
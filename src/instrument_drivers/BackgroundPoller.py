@@ -0,0 +1,66 @@
+import threading
+import logging
+
+"""
+Daemon thread calling poll() every interval seconds until stopped
+
+Subclasses implement poll() and hand their results to the subscribers through
+_notify(*args); exceptions of poll() and of the subscribers are logged and do not end
+the thread. Usable as a context manager, which starts and stops the polling.
+"""
+class BackgroundPoller:
+    def __init__(self, name, interval):
+        self.__name = name
+        self.__interval = interval
+        self.__subscribers = []
+        self.__stop_event = threading.Event()
+        self.__thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, except_type, except_val, except_trace):
+        self.stop()
+
+    @property
+    def is_running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def subscribe(self, callback):
+        self.__subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        if callback in self.__subscribers:
+            self.__subscribers.remove(callback)
+
+    def start(self):
+        if self.is_running:
+            return
+        self.__stop_event.clear()
+        self.__thread = threading.Thread(target = self.__run, name = self.__name.lower().replace(" ", "-"), daemon = True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop_event.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def poll(self):
+        raise NotImplementedError
+
+    def _notify(self, *args):
+        for callback in list(self.__subscribers):
+            try:
+                callback(*args)
+            except Exception as e:
+                logging.error(f"-> { self.__name } subscriber failed: { e }")
+
+    def __run(self):
+        while not self.__stop_event.wait(self.__interval):
+            try:
+                self.poll()
+            except Exception as e:
+                logging.warning(f"-> { self.__name } poll failed: { e }")
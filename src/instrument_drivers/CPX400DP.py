@@ -4,13 +4,80 @@ Created on Thu Feb 15 12:26:50 2024
 
 @author: marek novotny
 """
+from __future__ import annotations
 from src.instrument_drivers.InstrumentConnection import InstrumentConnection
 from src.instrument_drivers.Instrument import Instrument
+from src.instrument_drivers.DriverRegistry import DriverRegistry
 from src.instrument_drivers.generic import classproperty
+from src.instrument_drivers.ramp import Ramp
+from src.instrument_drivers.BackgroundPoller import BackgroundPoller
+from enum import IntFlag
+import threading
 import logging
 import time
 
+@DriverRegistry.register(manufacturer = "THURLBY|TTI|AIM", model = "CPX400")
 class CPX400DP(Instrument):
+    PACING = dict(min_gap = 10e-3, initial_gap = 100e-3, sync = InstrumentConnection.Pacing.Sync.OPC)
+    MAX_LINE_LENGTH = 80
+    SETTLE_TOLERANCE = 50e-3
+    SETTLE_TIMEOUT = 5
+
+    """
+    Limit status register (LSR<n>?) bits
+    """
+    class Limit(IntFlag):
+        VoltageLimit = 1
+        CurrentLimit = 2
+        OverVoltageTrip = 4
+        OverCurrentTrip = 8
+        PowerLimit = 16
+        HardTrip = 64
+
+    LIMIT_MESSAGES = {
+        Limit.VoltageLimit: "Output reached set voltage limit",
+        Limit.CurrentLimit: "Output reached set current limit",
+        Limit.OverVoltageTrip: "Overvoltage protection engaged",
+        Limit.OverCurrentTrip: "Overcurrent protection engaged",
+        Limit.PowerLimit: "Output power limitation engaged",
+        Limit.HardTrip: "Hard trip occured - perform manual reset",
+    }
+    TRIPS = Limit.OverVoltageTrip | Limit.OverCurrentTrip | Limit.HardTrip
+
+    """
+    Low-rate background monitor of the limit status registers
+
+    Polls LSR<n>? on the instrument session only while it is idle (see
+    InstrumentConnection.poll_query), so it never delays nor races the foreground
+    commands, and calls the subscribers with callback(channel, limits) whenever a
+    limit in mask was latched since the last report, whether it was read by the monitor
+    or by a foreground reader.
+    """
+    class LimitMonitor(BackgroundPoller):
+        def __init__(self, cpx: CPX400DP, channels = (1, 2), interval = 500e-3, mask = None):
+            super().__init__("CPX400DP limit monitor", interval)
+            self.__cpx = cpx
+            self.__channels = channels
+            self.__mask = CPX400DP.TRIPS if mask is None else mask
+            self.__events = []
+
+        @property
+        def events(self):
+            return list(self.__events)
+
+        def poll(self):
+            for channel in self.__channels:
+                self.__cpx._latch_limits(channel, self.__cpx._connection.poll_query("LSR" + str(channel) + "?", 1e-3))
+                limits = self.__cpx._take_unreported(channel, self.__mask)
+                if limits:
+                    self.__notify(channel, limits)
+
+        def __notify(self, channel, limits):
+            self.__events.append((time.time(), channel, limits))
+            for limit in limits:
+                logging.warning(f"-> OUT{ channel } { CPX400DP.LIMIT_MESSAGES[limit] }")
+            self._notify(channel, limits)
+
     @classproperty
     def default_addresses(cls):
         addresses = set()
@@ -19,21 +86,39 @@ class CPX400DP(Instrument):
         
         return addresses
 
-    def __init__(self, connection: InstrumentConnection):
-        super().__init__(connection)
+    def __init__(self, connection: InstrumentConnection, mode = "default"):
+        super().__init__(connection, mode)
+        self.__monitor = None
+        self.__limits_lock = threading.Lock()
+        self.__latched = dict()
+        self.__unreported = dict()
 
+    """
+    Any command following LOCAL puts the supply back into remote, so LOCAL is sent as
+    the last write on its own, without the *OPC? completion query
+    """
     def release(self):
-        self._connection.send("LOCAL")
+        self._connection.send("LOCAL", overlapped = True)
 
     def stop(self):
-        self.out_off(1)
-        self.out_off(2)
+        self.outs_off()
+        if self.__monitor is not None:
+            self.__monitor.stop()
+            self.__monitor = None
+
+    def monitor_limits(self, channels = (1, 2), interval = 500e-3, mask = None) -> CPX400DP.LimitMonitor:
+        if self.__monitor is not None:
+            self.__monitor.stop()
+        self.__monitor = CPX400DP.LimitMonitor(self, channels, interval, mask)
+        self.__monitor.start()
+        return self.__monitor
 
     def get_voltage(self, channel):
         return self._connection.send_query("V" + str(channel) + "?", 1e-3)
 
     def set_voltage(self, channel, value):
         self._connection.send("V" + str(channel) + " " + str(value))
+        self.state[f"voltage@{ channel }"] = value
         # self.daq_series.add_data_point(self.get_voltage())
 
     def get_current(self, channel):
@@ -41,19 +126,122 @@ class CPX400DP(Instrument):
 
     def set_current(self, channel, value):
         self._connection.send("I" + str(channel) + " " + str(value))
+        self.state[f"current@{ channel }"] = value
+
+    """
+    Multi-channel variants take {channel: value} and write all outputs in one transaction
+    """
+    def set_voltages(self, values: dict):
+        with self._connection.batch():
+            for channel, value in values.items():
+                self.set_voltage(channel, value)
+
+    def set_currents(self, values: dict):
+        with self._connection.batch():
+            for channel, value in values.items():
+                self.set_current(channel, value)
+
+    def get_output_voltage(self, channel):
+        return self.__parse_readback(self._connection.send_query("V" + str(channel) + "O?", 1e-3))
 
-    def out_on(self, channel, blanking_time = 1):
-        time.sleep(blanking_time)
-        self.__read_lim_status_reg_raw(channel)
+    def get_output_current(self, channel):
+        return self.__parse_readback(self._connection.send_query("I" + str(channel) + "O?", 1e-3))
+
+    """
+    Output switching waits until the output voltage readback settles within tolerance of
+    the set voltage (or of 0 V when switching off), or until the current limit engages.
+    A fixed blanking_time [s] sleep before switching is only used when given explicitly.
+    """
+    def out_on(self, channel, blanking_time = None, settle = True, tolerance = None, timeout = None):
+        if blanking_time is not None:
+            time.sleep(blanking_time)
+        self.read_limits(channel)
         self._connection.send("OP" + str(channel) + " 1")
         logging.info("-> Switching OUT" + str(channel) + " on")
         #self.report_lim_status(channel)
+        if settle and blanking_time is None:
+            return self.wait_settled(channel, self.__voltage_setpoint(channel), tolerance, timeout)
+        return True
 
-    def out_off(self, channel, blanking_time = 1):
-        time.sleep(blanking_time)
+    def out_off(self, channel, blanking_time = None, settle = True, tolerance = None, timeout = None):
+        if blanking_time is not None:
+            time.sleep(blanking_time)
         self._connection.send("OP" + str(channel) + " 0")
         logging.info("-> Switching OUT" + str(channel) + " off")
         #self.report_lim_status(channel)
+        if settle and blanking_time is None:
+            return self.wait_settled(channel, 0, tolerance, timeout)
+        return True
+
+    """
+    Both outputs are switched simultaneously by OPALL, a subset of them by batched OP<n>
+    """
+    def outs_on(self, channels = (1, 2), blanking_time = None, settle = True, tolerance = None, timeout = None):
+        if blanking_time is not None:
+            time.sleep(blanking_time)
+        for channel in channels:
+            self.read_limits(channel)
+        self.__switch_outputs(channels, 1)
+        if settle and blanking_time is None:
+            return self.wait_settled_all({ channel: self.__voltage_setpoint(channel) for channel in channels }, tolerance, timeout)
+        return True
+
+    def outs_off(self, channels = (1, 2), blanking_time = None, settle = True, tolerance = None, timeout = None):
+        if blanking_time is not None:
+            time.sleep(blanking_time)
+        self.__switch_outputs(channels, 0)
+        if settle and blanking_time is None:
+            return self.wait_settled_all({ channel: 0 for channel in channels }, tolerance, timeout)
+        return True
+
+    def __switch_outputs(self, channels, state):
+        if set(channels) == {1, 2}:
+            self._connection.send("OPALL " + str(state))
+        else:
+            with self._connection.batch():
+                for channel in channels:
+                    self._connection.send("OP" + str(channel) + " " + str(state))
+        logging.info("-> Switching OUT" + ", OUT".join([str(channel) for channel in channels]) + (" on" if state else " off"))
+
+    def wait_settled(self, channel, target, tolerance = None, timeout = None, poll_interval = 20e-3):
+        return self.wait_settled_all({ channel: target }, tolerance, timeout, poll_interval)
+
+    """
+    Polls every channel of targets ({ channel: voltage }) in one loop against a shared
+    deadline, so switching several outputs takes as long as the slowest one settling
+    """
+    def wait_settled_all(self, targets: dict, tolerance = None, timeout = None, poll_interval = 20e-3):
+        tolerance = self.SETTLE_TOLERANCE if tolerance is None else tolerance
+        deadline = time.monotonic() + (self.SETTLE_TIMEOUT if timeout is None else timeout)
+        pending = dict(targets)
+        readbacks = dict()
+        while True:
+            for channel, target in list(pending.items()):
+                readback = readbacks[channel] = self.get_output_voltage(channel)
+                if readback is not None and abs(readback - target) <= tolerance:
+                    del pending[channel]
+                elif readback is not None and target > 0 and self.Limit.CurrentLimit in self.read_limits(channel, clear = False):
+                    logging.info("-> OUT" + str(channel) + " settled in current limit")
+                    del pending[channel]
+            if len(pending) == 0:
+                return True
+            if time.monotonic() > deadline:
+                for channel, target in pending.items():
+                    logging.warning(f"-> OUT{ channel } did not settle at { target } V (readback { readbacks[channel] } V)")
+                return False
+            time.sleep(poll_interval)
+
+    def __voltage_setpoint(self, channel):
+        if self.state.get(f"voltage@{ channel }") is None:
+            self.state[f"voltage@{ channel }"] = self.__parse_readback(self.get_voltage(channel))
+        return self.state[f"voltage@{ channel }"]
+
+    @staticmethod
+    def __parse_readback(response):
+        try:
+            return float(response.strip().split()[-1].rstrip("VA"))
+        except (AttributeError, ValueError, IndexError):
+            return None
 
     def out_status(self, channel):
         return self._connection.send("OP" + str(channel) + "?", 1e-3)
@@ -70,37 +258,73 @@ class CPX400DP(Instrument):
         else:
             return "! unlock failed refer to instrument manual for possible causes"
 
-    def __read_lim_status_reg_raw(self, channel):
-        return bin(int(self._connection.send_query("LSR" + str(channel) + "?", 1e-3)))
+    @classmethod
+    def decode_limits(cls, response) -> Limit:
+        return cls.Limit(int(str(response).strip()) & sum(cls.Limit))
+
+    """
+    LSR<n>? clears the register on the instrument, so every read is latched per channel:
+    foreground readers take (and by default clear) all latched bits, while the limit
+    monitor separately takes the bits of its mask it has not reported yet. No reader
+    consumes the bits of another and no bit is dropped before a reader has seen it.
+    """
+    def _latch_limits(self, channel, response):
+        if response is None:
+            return None
+        limits = self.decode_limits(response)
+        with self.__limits_lock:
+            self.__latched[channel] = self.__latched.get(channel, self.Limit(0)) | limits
+            self.__unreported[channel] = self.__unreported.get(channel, self.Limit(0)) | limits
+        return limits
+
+    def _take_unreported(self, channel, mask) -> Limit:
+        with self.__limits_lock:
+            limits = self.__unreported.get(channel, self.Limit(0))
+            self.__unreported[channel] = limits & ~mask
+            return limits & mask
+
+    def read_limits(self, channel, clear = True) -> Limit:
+        self._latch_limits(channel, self._connection.send_query("LSR" + str(channel) + "?", 1e-3))
+        with self.__limits_lock:
+            limits = self.__latched.get(channel, self.Limit(0))
+            if clear:
+                self.__latched[channel] = self.Limit(0)
+            return limits
     
     def read_lim_status_active_bits(self, channel):
-        reg = self.__read_lim_status_reg_raw(channel)
-        active_bits = [(len(reg[2:]) - 1 - i) for i, bit in enumerate(reg[2:]) if bit == '1']
+        limits = int(self.read_limits(channel))
+        active_bits = [bit for bit in reversed(range(limits.bit_length())) if limits >> bit & 1]
 
         return active_bits
 
     def report_lim_status(self, channel):
-        active_bits = self.read_lim_status_active_bits(channel)
+        limits = self.read_limits(channel)
 
         logging.warning("OUT" + str(channel) + " Limits [")
-        for i, bit in enumerate(active_bits):
-            match i:
-                case 0:
-                    logging.warning("+ Output reached set voltage limit")
-                case 1:
-                    logging.warning("+ Output reached set current limit")
-                case 2:
-                    logging.warning("+ Overvoltage protection engaged")
-                case 3:
-                    logging.warning("+ Overcurrent protection engaged")
-                case 4:
-                    logging.warning("+ Output power limitation engaged")
-                case 6:
-                    logging.warning("+ Hard trip occured - perform manual reset")
+        for limit in limits:
+            logging.warning("+ " + self.LIMIT_MESSAGES[limit])
         logging.warning("]")
 
-    def ramp_voltage(self, channel, init_val, final_val, blanking_time = 50e-3):
-        ramp_range = range(init_val * 10, final_val * 10 + 1) if init_val < final_val else reversed(range(final_val * 10, init_val * 10 + 1))
-        for i in ramp_range:
-            time.sleep(blanking_time)
-            self.set_voltage(channel, i / 10)
+    def ramp_voltage(self, channel, init_val, final_val, blanking_time = 50e-3, step = 0.1, slew_rate = None):
+        return self.run_ramp(channel, Ramp.linear(init_val, final_val, step, blanking_time, slew_rate))
+
+    def ramp_voltages(self, init_vals: dict, final_vals: dict, blanking_time = 50e-3, step = 0.1, slew_rate = None):
+        channels = list(init_vals.keys())
+        ramp = Ramp.combine(*[Ramp.linear(init_vals[channel], final_vals[channel], step, blanking_time, slew_rate) for channel in channels])
+        return self.run_ramps(channels, ramp)
+
+    """
+    Runs a ramp with a column of setpoints per channel, e.g. Ramp.combine(ramp1, ramp2),
+    writing only the channels whose setpoint changed in one transaction per step
+    """
+    def run_ramps(self, channels, ramp: Ramp):
+        def apply(row):
+            self.set_voltages({channel: float(value) for channel, value in zip(channels, row) if self.state.get(f"voltage@{ channel }") != float(value)})
+        report = ramp.run(apply)
+        logging.info(f"-> OUT{ ', OUT'.join([str(channel) for channel in channels]) } ramp of { len(report) } steps finished in { report.duration :.3f} s (max lateness { report.max_lateness * 1e3 :.1f} ms)")
+        return report
+
+    def run_ramp(self, channel, ramp: Ramp):
+        report = ramp.run(lambda value: self.set_voltage(channel, value))
+        logging.info(f"-> OUT{ channel } ramp of { len(report) } steps finished in { report.duration :.3f} s (max lateness { report.max_lateness * 1e3 :.1f} ms)")
+        return report
@@ -1,18 +1,47 @@
 from __future__ import annotations
 from src.instrument_drivers.InstrumentConnection import InstrumentConnection
 from src.instrument_drivers.Instrument import Instrument
+from src.instrument_drivers.DriverRegistry import DriverRegistry
 from src.instrument_drivers.generic import classproperty
+from src.instrument_drivers.BackgroundPoller import BackgroundPoller
+from enum import StrEnum
 from copy import copy
+from time import sleep, monotonic
+import threading
+import logging
+import numpy as np
 
+@DriverRegistry.register(manufacturer = "KEITHLEY", model = "DMM6500")
 class DMM6500(Instrument):
     MODE_CTRL_CMD = ":SENS:FUNC"
+    DIGITIZE_CTRL_CMD = ":DIG:FUNC"
+    PACING = dict(sync = InstrumentConnection.Pacing.Sync.OPC)
+    MAX_LINE_LENGTH = 512
+    ROOTED_COMMANDS = True
+    BUFFER_CAPACITY = 100000
+    DEFAULT_BUFFER = "defbuffer1"
     
     class Mode(Instrument.Mode):
         DCVMeter = "VOLT:DC"
         DCAMeter = "VOLT:AC"
+        DCIMeter = "CURR:DC"
+        ACVMeter = "VOLT:AC"
+        ACIMeter = "CURR:AC"
+        Temperature = "TEMP"
+        DigitizeVoltage = "DIG:VOLT"
+        DigitizeCurrent = "DIG:CURR"
         R2PoleMeter = "RES"
         R4PoleMeter = "FRES"
 
+    class DataFormat(StrEnum):
+        ASCII = "ASC"
+        REAL = "REAL"
+        SREAL = "SREAL"
+
+    class Trigger(StrEnum):
+        Command = "COMM"
+        External = "EXT"
+
     class ChanRef(Instrument.ChanRef):
         CH1_TEMP_REF = "1"
         CH2 = "2"
@@ -25,6 +54,153 @@ class DMM6500(Instrument):
         CH9 = "9"
         CH10 = "10"
 
+    """
+    Background continuous-reading streamer
+
+    The trigger model measures into the reading buffer (fill mode CONT) until aborted,
+    while a reader thread tracks the buffer end index and drains only the new readings
+    into a fixed-size ring buffer, so memory stays constant regardless of the run length.
+    Subscribers are called with (timestamps, readings) of every drained chunk.
+    """
+    class Stream(BackgroundPoller):
+        def __init__(self, dmm: DMM6500, capacity = 100000, interval = 0, poll_interval = 100e-3, chunk = 10000):
+            super().__init__("DMM6500 stream", poll_interval)
+            self.__dmm = dmm
+            self.__interval = interval
+            self.__chunk = chunk
+            self.__last_timestamp = None
+            self.__overruns = 0
+            self.__restarts = 0
+            self.__times = np.full(capacity, np.nan)
+            self.__values = np.full(capacity, np.nan)
+            self.__written = 0
+            self.__last_index = 0
+            self.__buffer_size = None
+            self.__lock = threading.Lock()
+
+        @property
+        def capacity(self):
+            return len(self.__values)
+
+        @property
+        def count(self):
+            return self.__written
+
+        @property
+        def overruns(self):
+            return self.__overruns
+
+        @property
+        def restarts(self):
+            return self.__restarts
+
+        def start(self):
+            if self.is_running:
+                return
+            buffer = self.__dmm.DEFAULT_BUFFER
+            self.__buffer_size = self.__dmm.BUFFER_CAPACITY
+            connection = self.__dmm._connection
+            with connection.batch():
+                connection.send(f':TRAC:POIN { self.__buffer_size }, "{ buffer }"')
+                connection.send(f':TRAC:FILL:MODE CONT, "{ buffer }"')
+                connection.send(':TRIG:LOAD "Empty"')
+                connection.send(f':TRIG:BLOC:BUFF:CLE 1, "{ buffer }"')
+                connection.send(f':TRIG:BLOC:DEL:CONS 2, { self.__interval }')
+                connection.send(f':TRIG:BLOC:MDIG 3, "{ buffer }", 1')
+                connection.send(':TRIG:BLOC:BRAN:ALW 4, 2')
+            self.__arm()
+            super().start()
+
+        def stop(self):
+            running = self.is_running
+            super().stop()
+            if running:
+                self.__dmm._connection.send(':ABOR', overlapped = True)
+
+        def snapshot(self):
+            with self.__lock:
+                stored = min(self.__written, self.capacity)
+                start = (self.__written - stored) % self.capacity
+                order = (np.arange(stored) + start) % self.capacity
+                return self.__times[order], self.__values[order]
+
+        def latest(self):
+            with self.__lock:
+                if self.__written == 0:
+                    return None, None
+                idx = (self.__written - 1) % self.capacity
+                return self.__times[idx], self.__values[idx]
+
+        def decimated(self, points):
+            times, values = self.snapshot()
+            factor = max(1, int(np.ceil(len(values) / points)))
+            usable = len(values) - len(values) % factor
+            if factor == 1 or usable == 0:
+                return times, values
+            return times[:usable:factor], values[:usable].reshape(-1, factor).mean(axis = 1)
+
+        """
+        The trigger model loops until aborted; should it still go idle (e.g. aborted
+        from the front panel), it is re-armed. Readings overwritten in the ring buffer
+        before they were read (the slot read last holds a reading with another absolute
+        timestamp) are reported as an overrun and the drain continues from the oldest
+        reading still stored.
+        """
+        def poll(self):
+            connection = self.__dmm._connection
+            buffer = self.__dmm.DEFAULT_BUFFER
+            end = int(connection.send_query(f':TRAC:ACT:END? "{ buffer }"', 1e-3) or 0)
+            if self.__last_index > 0 and end > 0 and self.__overwritten():
+                self.__overruns += 1
+                logging.warning(f"-> DMM6500 stream overrun, the buffer wrapped past the last read reading and readings may be lost ({ self.__overruns } so far)")
+                first = int(connection.send_query(f':TRAC:ACT:STAR? "{ buffer }"', 1e-3) or 1)
+                spans = [(first, end)] if first <= end else [(first, self.__buffer_size), (1, end)]
+            elif end == self.__last_index or end == 0:
+                self.__check_running()
+                return
+            elif end > self.__last_index:
+                spans = [(self.__last_index + 1, end)]
+            else:
+                spans = [(self.__last_index + 1, self.__buffer_size), (1, end)]
+            for first, last in spans:
+                for start in range(first, last + 1, self.__chunk):
+                    stop = min(last, start + self.__chunk - 1)
+                    data = self.__dmm.read_buffer(start, stop, ("READ", "REL"))
+                    self.__push(data[:, 1], data[:, 0])
+            self.__last_index = end
+            self.__last_timestamp = self.__timestamp(end)
+
+        def __timestamp(self, index):
+            return tuple(self.__dmm.read_buffer(index, index, ("SEC", "FRAC"))[0])
+
+        def __overwritten(self):
+            return self.__timestamp(self.__last_index) != self.__last_timestamp
+
+        def __check_running(self):
+            status = self.__dmm._connection.send_query(':TRIG:STAT?', 1e-3)
+            if status is None or status.split(';')[0].strip().upper() in ("RUNNING", "WAITING", "BUILDING"):
+                return
+            self.__restarts += 1
+            logging.warning(f"-> DMM6500 stream trigger model went { status.split(';')[0].strip() }, re-arming it")
+            self.__arm()
+
+        def __arm(self):
+            self.__dmm._connection.send(':INIT', overlapped = True)
+            self.__dmm.state["buffer:capacity"] = self.__buffer_size
+            self.__last_index = 0
+            self.__last_timestamp = None
+
+        def __push(self, times, values):
+            with self.__lock:
+                for offset in range(0, len(values), self.capacity):
+                    part = slice(offset, offset + self.capacity)
+                    count = len(values[part])
+                    idx = (np.arange(count) + self.__written) % self.capacity
+                    self.__times[idx] = times[part]
+                    self.__values[idx] = values[part]
+                    self.__written += count
+            self._notify(times, values)
+
     @classproperty
     def default_addresses(cls):
         addresses = set()
@@ -34,73 +210,323 @@ class DMM6500(Instrument):
         
         return addresses
     
+    DATA_FORMAT = DataFormat.REAL
+    __DATATYPES = { DataFormat.REAL: 'd', DataFormat.SREAL: 'f' }
+
     def __init__(self, connection: InstrumentConnection, mode: Mode):
         super().__init__(connection, mode)
+        self.__stream = None
+
+    def __enter__(self):
+        super().__enter__()
+        self.data_format = self.DATA_FORMAT
+        return self
 
     def __call__(self, chan_ref: ChanRef, mode: Mode):
-        self.release()
         self.fallback_mode = self.mode if self.fallback_mode is None else self.fallback_mode
         channel = copy(self)
         channel.fallback_mode = None
         channel.channel_reference = chan_ref
         mode_ctrl = f'{self.MODE_CTRL_CMD} "{mode}", (@{chan_ref})'
-        self._connection.send(mode_ctrl)
-        self._connection.send(f'ROUT:CLOS (@{ chan_ref })')
+        with self._connection.batch():
+            self.release()
+            self._connection.send(mode_ctrl)
+            self.state[f"function@{ chan_ref }"] = mode
+            self.__close_channel(chan_ref)
         self.assert_mode(mode)
 
         return channel
 
-    @property
-    def mode(self):
+    def _query_mode(self):
         query = self._connection.send_query(':SENS:FUNC?', 10e-3)
+        if query is not None and query.strip().strip('"') == "NONE":
+            query = "DIG:" + self._connection.send_query(f'{ self.DIGITIZE_CTRL_CMD }?', 10e-3).strip().strip('"')
         return self.Mode(query)
     
     @Instrument.mode.setter
     def mode(self, mode: Mode):
         if mode == "default":
             return
+        elif self.state.get("mode") == mode:
+            return
         else:
-            mode_ctrl = f'{self.MODE_CTRL_CMD} "{mode}"'
+            if mode.startswith("DIG:"):
+                mode_ctrl = f'{self.DIGITIZE_CTRL_CMD} "{mode.removeprefix("DIG:")}"'
+            else:
+                mode_ctrl = f'{self.MODE_CTRL_CMD} "{mode}"'
             self._connection.send(mode_ctrl)
+            self.state["mode"] = mode
+            if self.state.get("route") is None:
+                self.state["function@front"] = mode
             self.assert_mode(mode)
 
+    @property
+    def data_format(self):
+        return self.state.get("format", self.DataFormat.ASCII)
+
+    """
+    Transfer format of readings. Binary formats are sent little-endian and decoded
+    straight into typed arrays; they only carry numeric buffer elements (READ, REL,
+    SEC, FRAC, ...), string elements need DataFormat.ASCII.
+    """
+    @data_format.setter
+    def data_format(self, data_format: DataFormat):
+        if self.state.get("format") == data_format:
+            return
+        with self._connection.batch():
+            self._connection.send(f':FORM:DATA { data_format }')
+            if data_format != self.DataFormat.ASCII:
+                self._connection.send(':FORM:BORD SWAP')
+        self.state["format"] = data_format
+
     def release(self):
-        self._connection.send('ROUT:OPEN (@ALLSLOTS)')
-        self._connection.send('TRIG:CONT REST')
+        with self._connection.batch():
+            self._connection.send('ROUT:OPEN (@ALLSLOTS)')
+            self._connection.send('TRIG:CONT REST')
+        if self.state.get("route", "unknown") is not None:
+            self.state.invalidate("mode")
+            if self.state.get("function@front") is not None:
+                self.state["mode"] = self.state["function@front"]
+        self.state["route"] = None
+
+    def __close_channel(self, chan_ref):
+        self._connection.send(f'ROUT:CLOS (@{ chan_ref })')
+        self.state["route"] = chan_ref
+        self.state.invalidate("mode")
+        if self.state.get(f"function@{ chan_ref }") is not None:
+            self.state["mode"] = self.state[f"function@{ chan_ref }"]
 
     def stop(self):
-        pass
+        if self.__stream is not None:
+            self.__stream.stop()
+            self.__stream = None
+
+    def stream(self, capacity = 100000, interval = 0, poll_interval = 100e-3) -> DMM6500.Stream:
+        if self.__stream is not None:
+            self.__stream.stop()
+        self.__stream = DMM6500.Stream(self, capacity, interval, poll_interval)
+        self.__stream.start()
+        return self.__stream
     
     def toggle_dcv_mode(self):
-        self._connection.send(':SENS:FUNC "VOLT:DC"')
-        self.assert_mode("VOLT:DC")
+        self.mode = self.Mode.DCVMeter
 
     def toggle_dci_mode(self):
-        self._connection.send(':SENS:FUNC "CURR:DC"')
-        self.assert_mode("CURR:DC")
+        self.mode = self.Mode.DCIMeter
     
     def toggle_acv_mode(self):
-        self._connection.send(':SENS:FUNC "VOLT:AC"')
-        self.assert_mode("VOLT:AC")
+        self.mode = self.Mode.ACVMeter
 
     def toggle_aci_mode(self):
-        self._connection.send(':SENS:FUNC "CURR:AC"')
-        self.assert_mode("CURR:AC")
+        self.mode = self.Mode.ACIMeter
     
     def set_v_range(self, range):
-        self._connection.send(':SENS:VOLT:RANG ' + str(range))
+        self.__set_range("VOLT", range)
 
     def set_i_range(self, range):
-        self._connection.send(':SENS:CURR:RANG ' + str(range))
+        self.__set_range("CURR", range)
 
-    def acquire_measurement(self, flush = True):
-        if self.fallback_mode != None:
-            self.release()
-            self.mode = self.fallback_mode
-        if self.channel_reference != None:
-            self.release()
-            self._connection.send(f'ROUT:CLOS (@{ self.channel_reference })')
-        meas_val = self._connection.send_query(':MEAS?', 1e-3)
-        if flush:
-            self._connection.send(':TRAC:CLE')
+    def __set_range(self, function, range):
+        if self.state.get(f"range:{ function }") == range:
+            return
+        self._connection.send(f':SENS:{ function }:RANG ' + str(range))
+        self.state[f"range:{ function }"] = range
+
+    """
+    Takes one reading on the front terminals (fallback mode) or on the channel of this
+    channel object; a float when a binary data format is active, the raw string otherwise.
+    Relays are only switched when the shadowed route differs, so repeated readings of the
+    same channel cost a single :MEAS? query. The reading buffer is cleared when flush is
+    True or, with the default None, only when it approaches its capacity.
+    """
+    def acquire_measurement(self, flush = None):
+        self.__prepare_route()
+        if self.data_format == self.DataFormat.ASCII:
+            meas_val = self._connection.send_query(':MEAS?', 1e-3)
+        else:
+            meas_val = self.__query_binary(':MEAS?', 1)
+            meas_val = None if meas_val is None else float(meas_val[0])
+        buffered = self.state.get("buffer:count", 0) + 1
+        if flush or (flush is None and buffered >= self.state.get("buffer:capacity", self.BUFFER_CAPACITY)):
+            self.clear_buffer()
+        else:
+            self.state["buffer:count"] = buffered
         return meas_val
+
+    def __prepare_route(self):
+        with self._connection.batch():
+            if self.fallback_mode != None:
+                if self.state.get("route", "unknown") is not None:
+                    self.release()
+                self.mode = self.fallback_mode
+            if self.channel_reference != None and self.state.get("route") != self.channel_reference:
+                self.release()
+                self.__close_channel(self.channel_reference)
+        if self.verify == Instrument.Verify.OnSample:
+            self.verify_state()
+
+    """
+    Arms a trigger model taking one reading per trigger event, count times: *TRG sent by
+    trigger() (Trigger.Command) or a pulse on EXT TRIG IN (Trigger.External). With emit
+    set, every event is also passed on as a pulse on EXT TRIG OUT, so the meters wired
+    to it sample at the same moment. Readings are collected with fetch().
+    """
+    def arm_triggered(self, count, source: Trigger = Trigger.External, emit = False, edge = "FALL"):
+        self.__prepare_route()
+        buffer = self.DEFAULT_BUFFER
+        measure_block = 3 if emit else 2
+        with self._connection.batch():
+            self._connection.send(f':TRAC:POIN { count }, "{ buffer }"')
+            self._connection.send(f':TRAC:CLE "{ buffer }"')
+            self._connection.send(':TRIG:LOAD "Empty"')
+            if source == self.Trigger.External:
+                self._connection.send(f':TRIG:EXT:IN:EDGE { edge }')
+            self._connection.send(f':TRIG:BLOC:WAIT 1, { source }')
+            if emit:
+                self._connection.send(':TRIG:EXT:OUT:STIM NOT1')
+                self._connection.send(':TRIG:BLOC:NOT 2, 1')
+            self._connection.send(f':TRIG:BLOC:MDIG { measure_block }, "{ buffer }", 1')
+            self._connection.send(f':TRIG:BLOC:BRAN:COUN { measure_block + 1 }, { count }, 1')
+        self._connection.send(':INIT', overlapped = True)
+        self.state["buffer:count"] = count
+        self.state["buffer:capacity"] = count
+
+    def trigger(self):
+        self._connection.send('*TRG', overlapped = True)
+
+    """
+    Waits for the index-th (1-based) reading of an armed trigger model and returns it
+    with its timestamp [s] relative to the first reading
+    """
+    def fetch(self, index, timeout = 10, poll_interval = 5e-3):
+        deadline = monotonic() + timeout
+        while int(self._connection.send_query(f':TRAC:ACT? "{ self.DEFAULT_BUFFER }"', 1e-3) or 0) < index:
+            if monotonic() > deadline:
+                raise TimeoutError(f"Reading { index } was not triggered in time")
+            sleep(poll_interval)
+        reading, timestamp = self.read_buffer(index, index, ("READ", "REL"))[0]
+        return float(reading), float(timestamp)
+
+    def abort(self):
+        self._connection.send(':ABOR', overlapped = True)
+
+    def clear_buffer(self):
+        self._connection.send(':TRAC:CLE')
+        self.state["buffer:count"] = 0
+
+    """
+    Buffered burst acquisition: the trigger model takes count readings (with the given
+    NPLC and interval [s] between them) into the reading buffer, which is then read back
+    in one TRAC:DATA? transfer. Returns the readings and their instrument-side relative
+    timestamps [s] as NumPy arrays.
+    """
+    def burst(self, count, nplc = None, interval = 0, timeout = None):
+        buffer = self.DEFAULT_BUFFER
+        with self._connection.batch():
+            if nplc is not None:
+                self._connection.send(f':SENS:{ self.mode }:NPLC { nplc }')
+            self._connection.send(f':TRAC:POIN { count }, "{ buffer }"')
+            self._connection.send(f':TRAC:CLE "{ buffer }"')
+            self._connection.send(f':TRIG:LOAD "SimpleLoop", { count }, { interval }, "{ buffer }"')
+        self._connection.send(':INIT', overlapped = True)
+        self.state["buffer:count"] = count
+        self.state["buffer:capacity"] = count
+        self.wait_trigger_idle(timeout if timeout is not None else 10 + count * (interval + 0.1))
+        data = self.read_buffer(1, count, ("READ", "REL"))
+        return data[:, 0], data[:, 1]
+
+    """
+    Hardware scan across several scanner card channels, each with its own function, e.g.
+
+        dmm.scan({ DMM6500.ChanRef.CH1_TEMP_REF: DMM6500.Mode.Temperature,
+                   DMM6500.ChanRef.CH2: DMM6500.Mode.DCVMeter }, count = 10)
+
+    The scan list is built with ROUT:SCAN, run by the instrument count times and read
+    back in one transfer. Returns a NumPy structured array with one record per sweep,
+    holding the sweep timestamp 't' [s] and one field per channel named after its ChanRef.
+    """
+    def scan(self, channels: dict, count = 1, interval = 0, timeout = None):
+        chan_refs = [self.ChanRef(chan_ref) for chan_ref in channels.keys()]
+        points = count * len(chan_refs)
+        buffer = self.DEFAULT_BUFFER
+        with self._connection.batch():
+            self.release()
+            for chan_ref, mode in channels.items():
+                self._connection.send(f'{ self.MODE_CTRL_CMD } "{ mode }", (@{ chan_ref })')
+                self.state[f"function@{ chan_ref }"] = mode
+            self._connection.send(f':ROUT:SCAN:CRE (@{ ",".join(chan_refs) })')
+            self._connection.send(f':ROUT:SCAN:COUN:SCAN { count }')
+            self._connection.send(f':ROUT:SCAN:INT { interval }')
+            self._connection.send(f':TRAC:POIN { points }, "{ buffer }"')
+            self._connection.send(f':TRAC:CLE "{ buffer }"')
+        self._connection.send(':INIT', overlapped = True)
+        self.state.invalidate("route", "mode")
+        self.state["buffer:count"] = points
+        self.state["buffer:capacity"] = points
+        self.wait_trigger_idle(timeout if timeout is not None else 10 + count * (interval + 0.2 * len(chan_refs)))
+        data = self.read_buffer(1, points, ("READ", "REL")).reshape(count, len(chan_refs), 2)
+        sweeps = np.empty(count, dtype = [("t", float)] + [(chan_ref.name, float) for chan_ref in chan_refs])
+        sweeps["t"] = data[:, 0, 1]
+        for idx, chan_ref in enumerate(chan_refs):
+            sweeps[chan_ref.name] = data[:, idx, 0]
+        return sweeps
+
+    """
+    Digitizer capture of count samples at sample_rate [S/s] with DIG:VOLT or DIG:CURR.
+    While the trigger model is still running, the filled part of the reading buffer is
+    streamed out in chunks of at most chunk samples into a preallocated array (out, if
+    given), so multi-second captures never hold the whole record as text.
+    """
+    def digitize(self, count, sample_rate = 1e6, mode: Mode = Mode.DigitizeVoltage, chunk = 100000, out = None, timeout = None, poll_interval = 50e-3):
+        out = np.empty(count, dtype = float) if out is None else out
+        if len(out) < count:
+            raise ValueError("Capture array is shorter than the sample count")
+        buffer = self.DEFAULT_BUFFER
+        function = mode.removeprefix("DIG:")
+        self.mode = mode
+        with self._connection.batch():
+            self._connection.send(f':DIG:{ function }:SRAT { sample_rate }')
+            self._connection.send(f':DIG:COUN { count }')
+            self._connection.send(f':TRAC:POIN { count }, "{ buffer }"')
+            self._connection.send(f':TRAC:CLE "{ buffer }"')
+            self._connection.send(f':TRIG:LOAD "SimpleLoop", 1, 0, "{ buffer }"')
+        self._connection.send(':INIT', overlapped = True)
+        self.state["buffer:count"] = count
+        self.state["buffer:capacity"] = count
+        deadline = monotonic() + (timeout if timeout is not None else 10 + 2 * count / sample_rate)
+        read = 0
+        while read < count:
+            available = int(self._connection.send_query(f':TRAC:ACT? "{ buffer }"', 1e-3) or 0)
+            if available > read:
+                stop = min(available, read + chunk)
+                out[read:stop] = self.read_buffer(read + 1, stop)[:, 0]
+                read = stop
+                continue
+            if monotonic() > deadline:
+                raise TimeoutError(f"Digitizer capture stalled after { read } of { count } samples")
+            sleep(poll_interval)
+        return out[:count]
+
+    def wait_trigger_idle(self, timeout, poll_interval = 10e-3):
+        deadline = monotonic() + timeout
+        while True:
+            status = self._connection.send_query(':TRIG:STAT?', 1e-3)
+            if status is not None and status.split(';')[0].strip().upper() not in ("RUNNING", "WAITING", "BUILDING"):
+                return status
+            if monotonic() > deadline:
+                raise TimeoutError("Trigger model did not finish in time")
+            sleep(poll_interval)
+
+    def read_buffer(self, start, end, elements = ("READ",), buffer = None):
+        buffer = self.DEFAULT_BUFFER if buffer is None else buffer
+        query = f':TRAC:DATA? { start }, { end }, "{ buffer }", { ", ".join(elements) }'
+        if self.data_format == self.DataFormat.ASCII:
+            values = self._connection.send_query_values(query, container = np.array)
+        else:
+            values = self.__query_binary(query, (end - start + 1) * len(elements))
+        if values is None:
+            raise IOError("Reading buffer transfer failed")
+        return np.asarray(values, dtype = float).reshape(-1, len(elements))
+
+    def __query_binary(self, query, data_points):
+        return self._connection.send_query_binary(query, self.__DATATYPES[self.data_format], container = np.array, data_points = data_points)
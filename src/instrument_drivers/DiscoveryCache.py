@@ -0,0 +1,69 @@
+from pathlib import Path
+from time import time
+import threading
+import logging
+import json
+from src.instrument_drivers.jsonfile import write_atomic
+
+"""
+Persistent cache of discovered VISA addresses and their *IDN? responses
+
+Entries older than ttl seconds are ignored on load. The file is rewritten atomically
+so that a crashed or concurrently started script never sees a partial cache.
+"""
+class DiscoveryCache:
+    DEFAULT_PATH = Path.home().joinpath(".instrument_env", "discovery.json")
+    VERSION = 1
+
+    def __init__(self, path = None, ttl = 24 * 3600):
+        self.__path = Path(self.DEFAULT_PATH if path is None else path)
+        self.__ttl = ttl
+        self.__lock = threading.Lock()
+
+    @property
+    def path(self):
+        return self.__path
+
+    @property
+    def ttl(self):
+        return self.__ttl
+
+    def load(self) -> dict:
+        now = time()
+        return { addr: entry["idn"] for addr, entry in self.__read().items() if now - entry["timestamp"] < self.__ttl }
+
+    def store(self, handshakes: dict):
+        with self.__lock:
+            entries = self.__read()
+            now = time()
+            for addr, idn in handshakes.items():
+                entries[addr] = dict(idn = idn, timestamp = now)
+            self.__write(entries)
+
+    def update(self, address, idn):
+        self.store({ address: idn })
+
+    def invalidate(self, address = None):
+        with self.__lock:
+            entries = dict() if address is None else self.__read()
+            entries.pop(address, None)
+            self.__write(entries)
+
+    def __read(self) -> dict:
+        try:
+            with self.__path.open("r") as cache_file:
+                content = json.load(cache_file)
+            if content.get("version") != self.VERSION:
+                return dict()
+            return content.get("entries", dict())
+        except FileNotFoundError:
+            return dict()
+        except (OSError, ValueError, AttributeError):
+            logging.warning(f"-> Discovery cache { self.__path } is unreadable, ignoring it")
+            return dict()
+
+    def __write(self, entries: dict):
+        try:
+            write_atomic(self.__path, dict(version = self.VERSION, entries = entries))
+        except OSError:
+            logging.warning(f"-> Discovery cache { self.__path } could not be written")
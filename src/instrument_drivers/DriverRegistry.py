@@ -0,0 +1,124 @@
+from __future__ import annotations
+from pathlib import Path
+import threading
+import logging
+import json
+import re
+
+"""
+Registry mapping *IDN? responses to driver classes
+
+Drivers register the manufacturer/model (and optionally serial) patterns of the
+instruments they control. A registry instance indexes discovered addresses by serial
+number and (lazily, so drivers imported later are still found) by driver, and resolves measurement roles configured in a JSON file, e.g.
+
+    {
+        "voltmeter": { "driver": "DMM6500", "serial": "04612268" },
+        "ammeter": { "driver": "DMM6500", "serial": "04612414" },
+        "supply": { "driver": "CPX400DP", "address": "ASRL4::INSTR" }
+    }
+"""
+class DriverRegistry:
+    DEFAULT_ROLES_PATH = Path.home().joinpath(".instrument_env", "roles.json")
+    __DRIVERS = []
+
+    class Identity:
+        def __init__(self, idn: str):
+            fields = [field.strip() for field in str(idn).split(',')] + ["", "", "", ""]
+            self.manufacturer, self.model, self.serial, self.firmware = fields[:4]
+
+    class Pattern:
+        def __init__(self, manufacturer, model, serial = None):
+            self.__manufacturer = re.compile(manufacturer, re.IGNORECASE)
+            self.__model = re.compile(model, re.IGNORECASE)
+            self.__serial = None if serial is None else re.compile(serial, re.IGNORECASE)
+
+        def matches(self, identity: DriverRegistry.Identity):
+            return (self.__manufacturer.search(identity.manufacturer) is not None
+                    and self.__model.search(identity.model) is not None
+                    and (self.__serial is None or self.__serial.search(identity.serial) is not None))
+
+    @classmethod
+    def register(cls, manufacturer, model, serial = None):
+        def decorator(driver):
+            cls.__DRIVERS.append((cls.Pattern(manufacturer, model, serial), driver))
+            return driver
+        return decorator
+
+    @classmethod
+    def identify(cls, idn):
+        identity = cls.Identity(idn)
+        for pattern, driver in cls.__DRIVERS:
+            if pattern.matches(identity):
+                return driver
+        return None
+
+    @classmethod
+    def driver_by_name(cls, name):
+        for _, driver in cls.__DRIVERS:
+            if driver.__name__ == name:
+                return driver
+        raise LookupError(f"No driver named { name } is registered")
+
+    def __init__(self, roles_path = None):
+        self.__idns = dict()
+        self.__by_serial = dict()
+        self.__by_driver = dict()
+        self.__roles = dict()
+        self.__lock = threading.RLock()
+        self.load_roles(self.DEFAULT_ROLES_PATH if roles_path is None else roles_path)
+
+    @property
+    def roles(self):
+        return self.__roles
+
+    def add(self, address, idn):
+        with self.__lock:
+            self.remove(address)
+            self.__idns[address] = idn
+            serial = self.Identity(idn).serial
+            if serial != "":
+                self.__by_serial[serial] = address
+            self.__by_driver.clear()
+
+    def remove(self, address):
+        with self.__lock:
+            if self.__idns.pop(address, None) is None:
+                return
+            for serial in [serial for serial, addr in self.__by_serial.items() if addr == address]:
+                del self.__by_serial[serial]
+            self.__by_driver.clear()
+
+    def addresses(self, driver):
+        with self.__lock:
+            if driver not in self.__by_driver:
+                self.__by_driver[driver] = [addr for addr, idn in self.__idns.items() if self.identify(idn) is driver]
+            return list(self.__by_driver[driver])
+
+    def driver(self, address):
+        with self.__lock:
+            return self.identify(self.__idns[address]) if address in self.__idns else None
+
+    def load_roles(self, path):
+        path = Path(path)
+        if not path.exists():
+            return
+        try:
+            with path.open("r") as roles_file:
+                self.__roles = json.load(roles_file)
+            logging.info(f"-> Loaded { len(self.__roles) } instrument roles from { path }")
+        except (OSError, ValueError):
+            logging.warning(f"-> Instrument roles file { path } is unreadable, ignoring it")
+
+    def resolve_role(self, role):
+        spec = self.__roles.get(role)
+        if spec is None:
+            return None, None
+        driver = self.driver_by_name(spec["driver"]) if "driver" in spec else None
+        if "address" in spec:
+            return spec["address"], driver
+        if "serial" in spec:
+            with self.__lock:
+                address = self.__by_serial.get(spec["serial"])
+            return address, (driver if address is None or driver is not None else self.driver(address))
+        return None, driver
@@ -1,11 +1,14 @@
 from __future__ import annotations
 from src.instrument_drivers.InstrumentConnection import InstrumentConnection
 from src.instrument_drivers.generic import classproperty
-from enum import StrEnum
+from enum import Enum, StrEnum, auto
 import logging
 
 class Instrument:
     MODE_CTRL_CMD = ""
+    PACING = None
+    MAX_LINE_LENGTH = None
+    ROOTED_COMMANDS = False
 
     class Mode(StrEnum):
         pass
@@ -13,15 +16,45 @@ class Instrument:
     class ChanRef(StrEnum):
         pass
 
+    class Verify(Enum):
+        Always = auto()
+        OnSample = auto()
+        Never = auto()
+
+    """
+    Write-through shadow of the instrument state (mode, ranges, routing)
+
+    Values are stored when they are written to the instrument and served from here
+    instead of being queried back. Keys in unverified were written but not yet read
+    back from the instrument (see Instrument.Verify).
+    """
+    class State(dict):
+        def __init__(self):
+            super().__init__()
+            self.unverified = set()
+
+        def invalidate(self, *keys):
+            for key in (keys if len(keys) > 0 else list(self.keys())):
+                self.pop(key, None)
+                self.unverified.discard(key)
+
+    VERIFY = Verify.Always
+
     @classproperty
     def default_addresses(cls):
         raise NotImplementedError("Instrument subclass must implement 'default_addresses' property getter method")
     
     def __init__(self, connection: InstrumentConnection, mode: str = "default"):
         self.__connection = connection
+        if self.PACING is not None:
+            self.__connection.pacing = InstrumentConnection.Pacing(**self.PACING)
+        self.__connection.max_line_length = self.MAX_LINE_LENGTH
+        self.__connection.rooted_commands = self.ROOTED_COMMANDS
         self.__mode = mode
         self.__fallback_mode = None
         self.__channel_reference = None
+        self.__state = Instrument.State()
+        self.__verify = self.VERIFY
         self.__set_enum_defaults(self.Mode)
         self.__set_enum_defaults(self.ChanRef)
            
@@ -35,16 +68,31 @@ class Instrument:
     def __exit__(self, except_type, except_val, except_trace):
         logging.info("-> Remote lock released")
         self.stop()
-        self.reset()
-        self.release()
+        with self.__connection.batch():
+            self.reset()
+            self.release()
 
     @property
     def _connection(self):
         return self.__connection
 
+    @property
+    def state(self):
+        return self.__state
+
+    @property
+    def verify(self):
+        return self.__verify
+
+    @verify.setter
+    def verify(self, policy: Verify):
+        self.__verify = policy
+
     @property
     def mode(self):
-        return self._connection.send_query(f'{self.MODE_CTRL_CMD}?', 10e-3)
+        if self.__state.get("mode") is None:
+            self.__state["mode"] = self._query_mode()
+        return self.__state["mode"]
     
     @property
     def fallback_mode(self):
@@ -67,13 +115,31 @@ class Instrument:
         self.__channel_reference = chan_ref
 
     def __set_enum_defaults(self, base_enum: StrEnum):
-        enum_dict = { i.name : i.value for i in base_enum }
+        enum_dict = { name : i.value for name, i in base_enum.__members__.items() }
         enum_dict["Default"] = "default"
         extended_enum = StrEnum(base_enum.__name__, enum_dict)
         setattr(self, base_enum.__name__, extended_enum)
 
+    def _query_mode(self):
+        return self._connection.send_query(f'{self.MODE_CTRL_CMD}?', 10e-3)
+
     def assert_mode(self, mode: Mode):
-        assert self.mode == mode, "Mode assertion error"
+        match self.__verify:
+            case Instrument.Verify.Always:
+                self.__state.invalidate("mode")
+                assert self.mode == mode, "Mode assertion error"
+            case Instrument.Verify.OnSample:
+                self.__state.unverified.add("mode")
+            case Instrument.Verify.Never:
+                pass
+
+    def verify_state(self):
+        if "mode" not in self.__state.unverified:
+            return
+        expected = self.__state.get("mode")
+        self.__state.invalidate("mode")
+        assert self.mode == expected, "Mode assertion error"
 
     def reset(self):
         self.__connection.send('*RST')
+        self.__state.invalidate()
@@ -1,9 +1,81 @@
 from pyvisa import ResourceManager
+from src.instrument_drivers.SessionPool import SessionPool
+from enum import StrEnum
+from contextlib import contextmanager
 import logging
-from time import sleep
+from time import sleep, monotonic
+import threading
 
 class InstrumentConnection:
-    def __init__(self, address, handler: ResourceManager, baudrate = 9600, timeout = 1000, r_terminator = '\n', w_terminator = '\n'):
+
+    """
+    Inter-command pacing policy of a single connection
+
+    Instead of sleeping a fixed time before every transaction the policy only waits
+    for the remainder of the gap since the previous transaction ended. The gap starts
+    at initial_gap and decays towards min_gap only on transactions the instrument
+    verifiably completed (a query answered, or a write completed by *OPC?), while a
+    failed transaction backs it off again (up to max_gap). A plain write never shrinks
+    the gap, since instruments (notably on serial links) may drop commands silently.
+    With Sync.OPC every write is completed by an appended *OPC? query, so the
+    instrument itself paces the traffic.
+    """
+    class Pacing:
+        class Sync(StrEnum):
+            NONE = "none"
+            OPC = "opc"
+
+        def __init__(self, min_gap = 0, initial_gap = None, max_gap = 500e-3, sync: Sync = Sync.NONE, adaptive = True, decay = 0.9):
+            self.__min_gap = min_gap
+            self.__max_gap = max_gap
+            self.__gap = min_gap if initial_gap is None else initial_gap
+            self.__sync = sync
+            self.__adaptive = adaptive
+            self.__decay = decay
+            self.__last_transaction = None
+
+        @classmethod
+        def for_address(cls, address: str):
+            if isinstance(address, str) and address.startswith("ASRL"):
+                return cls(min_gap = 100e-3, initial_gap = 100e-3)
+            return cls()
+
+        @property
+        def gap(self):
+            return self.__gap
+
+        @property
+        def min_gap(self):
+            return self.__min_gap
+
+        @property
+        def sync(self):
+            return self.__sync
+
+        @sync.setter
+        def sync(self, sync: Sync):
+            self.__sync = sync
+
+        def wait(self, delay = None):
+            gap = self.__gap if delay is None else max(delay, self.__gap)
+            if self.__last_transaction is None or gap <= 0:
+                return
+            remaining = self.__last_transaction + gap - monotonic()
+            if remaining > 0:
+                sleep(remaining)
+
+        def succeeded(self, verified = True):
+            self.__last_transaction = monotonic()
+            if self.__adaptive and verified:
+                self.__gap = max(self.__min_gap, self.__gap * self.__decay)
+
+        def failed(self):
+            self.__last_transaction = monotonic()
+            if self.__adaptive:
+                self.__gap = min(self.__max_gap, max(2 * self.__gap, 10e-3))
+                logging.debug(f"-> Command gap backed off to { self.__gap * 1e3 :.1f} ms")
+
+    def __init__(self, address, handler: ResourceManager, baudrate = 9600, timeout = 1000, r_terminator = '\n', w_terminator = '\n', pacing: Pacing = None, pool: SessionPool = None):
         self.__address = address
         self.__handler = handler
         self.__baudrate = baudrate
@@ -11,44 +83,197 @@ class InstrumentConnection:
         self.__read_terminator = r_terminator
         self.__write_terminator = w_terminator
         self.__connection = None
+        self.__session = None
+        self.__lock = threading.RLock()
+        self.__pool = SessionPool.shared() if pool is None else pool
+        self.__pacing = self.Pacing.for_address(address) if pacing is None else pacing
+        self.__max_line_length = None
+        self.__rooted_commands = False
+        self.__batch_depth = 0
+        self.__batch_queue = []
 
     def __enter__(self):
         try:
-            self.__connection = self.__handler.open_resource(self.__address)
-            self.__connection.read_termination = self.__read_terminator
-            self.__connection.write_termination = self.__write_terminator
-            self.__connection.baudrate = self.__baudrate
-            self.__connection.timeout = self.__timeout
+            session = self.__pool.acquire(self.__address, self.__handler,
+                                          read_termination = self.__read_terminator,
+                                          write_termination = self.__write_terminator,
+                                          baudrate = self.__baudrate,
+                                          timeout = self.__timeout)
+            self.__session = session
+            self.__connection = session.resource
+            self.__lock = session.lock
         except Exception as e:
             logging.error("-> Connection to instrument was unsuccessful")
             raise e
         return self
 
     def __exit__(self, except_type, except_val, except_trace):
-        try:
-            self.__connection.close()
-            self.__connection = None
-            logging.info("-> Connection to instrument closed")
-        except:
+        if self.__connection is None:
             logging.warning("-> Connection could not be closed or is not open")
+            return
+        self.__connection = None
+        self.__pool.release(self.__address, self.__session)
+        self.__session = None
+        logging.info("-> Connection to instrument released")
 
     @property
     def is_open(self):
         return self.__connection is not None
 
-    def send(self, cmd, delay = 100e-3):
+    @property
+    def address(self):
+        return self.__address
+
+    @property
+    def lock(self):
+        return self.__lock
+
+    @property
+    def pacing(self):
+        return self.__pacing
+
+    @pacing.setter
+    def pacing(self, pacing: Pacing):
+        self.__pacing = pacing
+
+    @property
+    def max_line_length(self):
+        return self.__max_line_length
+
+    @max_line_length.setter
+    def max_line_length(self, length):
+        self.__max_line_length = length
+
+    @property
+    def rooted_commands(self):
+        return self.__rooted_commands
+
+    @rooted_commands.setter
+    def rooted_commands(self, rooted: bool):
+        self.__rooted_commands = rooted
+
+    @property
+    def is_batching(self):
+        return self.__batch_depth > 0
+
+    """
+    Coalesces every command sent inside the context into as few writes as possible
+
+    Consecutive commands are joined with ';' (and re-rooted with ':' for hierarchical
+    SCPI instruments) up to max_line_length characters per write. Queued commands are
+    flushed when the outermost batch exits or before any query is issued, so the
+    ordering against queries is preserved. Batches may be nested. The session lock is
+    held for the whole outermost batch, so other threads (e.g. a stream or a monitor
+    polling the instrument) neither flush nor join a batch that is being built.
+    """
+    @contextmanager
+    def batch(self):
+        with self.__lock:
+            self.__batch_depth += 1
+            try:
+                yield self
+            except:
+                self.__batch_depth -= 1
+                if self.__batch_depth == 0 and len(self.__batch_queue) > 0:
+                    logging.warning(f"-> Discarding { len(self.__batch_queue) } batched commands")
+                    self.__batch_queue = []
+                raise
+            self.__batch_depth -= 1
+            if self.__batch_depth == 0:
+                self.flush()
+
+    def flush(self):
+        with self.__lock:
+            queued, self.__batch_queue = self.__batch_queue, []
+            for line in self.__coalesce(queued):
+                self.__write(line)
+
+    def __coalesce(self, cmds):
+        suffix = len(';*OPC?') if self.__pacing.sync == self.Pacing.Sync.OPC else 0
+        line = None
+        for cmd in cmds:
+            if line is None:
+                line = cmd
+                continue
+            if self.__rooted_commands and not cmd.startswith((':', '*')):
+                cmd = ':' + cmd
+            if self.__max_line_length is not None and len(line) + 1 + len(cmd) + suffix > self.__max_line_length:
+                yield line
+                line = cmd
+                continue
+            line = f'{line};{cmd}'
+        if line is not None:
+            yield line
+
+    """
+    Runs one paced transaction on the session; the caller holds the session lock
+    """
+    def __transact(self, fn, delay = None, verified = True):
         try:
-            sleep(delay)
-            self.__connection.write(cmd)
-        except:
+            self.__pacing.wait(delay)
+            result = fn()
+            self.__pacing.succeeded(verified = verified)
+            return result
+        except Exception:
+            self.__pacing.failed()
             logging.error("-> Communication with instrument was unsuccessful")
 
-    def send_query(self, query, await_time, delay = 100e-3):
+    def __write(self, cmd, delay = None, overlapped = False):
+        with self.__lock:
+            if self.__pacing.sync == self.Pacing.Sync.OPC and not overlapped:
+                self.__transact(lambda: self.__connection.query(f'{cmd};*OPC?'), delay)
+            else:
+                self.__transact(lambda: self.__connection.write(cmd), delay, verified = False)
+
+    """
+    Overlapped commands (e.g. INIT starting a trigger model) are never batched nor
+    completed with *OPC?, which would block until the whole operation finishes.
+    """
+    def send(self, cmd, delay = None, overlapped = False):
+        if overlapped:
+            with self.__lock:
+                self.flush()
+                self.__write(cmd, delay, overlapped)
+            return
+        with self.__lock:
+            if self.__batch_depth > 0:
+                self.__batch_queue.append(cmd)
+                return
+            self.__write(cmd, delay)
+
+    def send_query(self, query, await_time, delay = None):
+        with self.__lock:
+            self.flush()
+            return self.__transact(lambda: self.__connection.query(query, await_time), delay)
+
+    """
+    Background query (e.g. status monitoring) that never waits for nor interleaves with
+    the foreground traffic: it is skipped, returning None, whenever the session is busy
+    or commands are being batched.
+    """
+    def poll_query(self, query, await_time):
+        if not self.__lock.acquire(blocking = False):
+            return None
         try:
-            sleep(delay)
-            return self.__connection.query(query, await_time)
-        except:
-            logging.error("-> Communication with instrument was unsuccessful")
+            if self.__batch_depth > 0 or len(self.__batch_queue) > 0:
+                return None
+            return self.__transact(lambda: self.__connection.query(query, await_time))
+        finally:
+            self.__lock.release()
+
+    def send_query_values(self, query, container = list, delay = None):
+        with self.__lock:
+            self.flush()
+            return self.__transact(lambda: self.__connection.query_ascii_values(query, container = container), delay)
+
+    """
+    data_points is required for indefinite-length (#0) blocks, whose size the header
+    does not state
+    """
+    def send_query_binary(self, query, datatype = 'd', is_big_endian = False, container = list, data_points = 0, delay = None):
+        with self.__lock:
+            self.flush()
+            return self.__transact(lambda: self.__connection.query_binary_values(query, datatype = datatype, is_big_endian = is_big_endian, container = container, data_points = data_points), delay)
 
     def handshake(self):
         return self.send_query('*IDN?', 1e-3)
@@ -5,25 +5,57 @@ Created on Mon Feb 12 16:15:53 2024
 @author: marek novotny
 """
 
-from pyvisa import ResourceManager
 from src.instrument_drivers.InstrumentConnection import InstrumentConnection
+from src.instrument_drivers.SessionPool import SessionPool
+from src.instrument_drivers.DiscoveryCache import DiscoveryCache
+from src.instrument_drivers.DriverRegistry import DriverRegistry
 from src.instrument_drivers.Instrument import Instrument
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+from enum import Enum, auto
+from time import monotonic
+import threading
 import logging
-from msvcrt import getch
+try:
+    from msvcrt import getch
+except ImportError:
+    getch = None
 
 class InstrumentDiscovery:
+    class Revalidation(Enum):
+        Lazy = auto()
+        Background = auto()
 
-    def __init__(self):
-        self.__resources = ResourceManager()
-        self.__discovered = list(self.__resources.list_resources())
+    def __init__(self, pool: SessionPool = None, probe_timeout = 500, discovery_budget = 5, max_workers = 16,
+                 cache: DiscoveryCache = None, use_cache = True, revalidation: Revalidation = Revalidation.Lazy, roles_path = None,
+                 handshake_retry = 30):
+        self.__pool = SessionPool.shared() if pool is None else pool
+        self.__probe_timeout = probe_timeout
+        self.__discovery_budget = discovery_budget
+        self.__max_workers = max_workers
+        self.__handshake_retry = handshake_retry
+        self.__retry_at = dict()
+        self.__resources = self.__pool.resource_manager
+        self.__cache = (DiscoveryCache() if cache is None else cache) if use_cache else None
+        self.__lock = threading.RLock()
+        self.__registry = DriverRegistry(roles_path)
         self.__handshakes = dict()
-        self.get_handshakes()
+        self.__unverified = set()
         self.__default_addresses = set()
         self.__allocated = []
-
-    def __del__(self):
-        logging.info("-> Resources successfully released")
-        self.__resources.close()
+        self.__allocating = None
+        self.__reserved = set()
+        cached = dict() if self.__cache is None else self.__cache.load()
+        if len(cached) > 0:
+            logging.info(f"-> Trusting { len(cached) } cached instrument handshakes")
+            self.__discovered = list(cached.keys())
+            for addr, inst_name in cached.items():
+                self.__record(addr, inst_name)
+            self.__unverified.update(cached.keys())
+            if revalidation == self.Revalidation.Background:
+                threading.Thread(target = self.rescan, name = "discovery-revalidation", daemon = True).start()
+        else:
+            self.__discovered = list(self.__resources.list_resources())
+            self.get_handshakes()
 
     def __iter__(self):
         return self
@@ -31,12 +63,16 @@ class InstrumentDiscovery:
     @property
     def connection_handler(self):
         return self.__resources
+
+    @property
+    def session_pool(self):
+        return self.__pool
     
     @property
     def next_default_address(self):
         address_served = False
         for addr in self.__default_addresses:
-            if addr not in self.__handshakes.keys():
+            if addr not in self.__handshakes.keys() or not self.revalidate(addr):
                 logging.warning(f"-> Instrument at address {addr} did not respond")
                 continue
             address_served = True
@@ -56,15 +92,146 @@ class InstrumentDiscovery:
     def default_addresses(self, addresses):
         self.__default_addresses = addresses
 
+    @property
+    def cache(self):
+        return self.__cache
+
+    @property
+    def registry(self):
+        return self.__registry
+
     def get_handshakes(self) -> None:
-        for idx, addr in enumerate(self.__discovered):
-            with InstrumentConnection(addr, self.__resources) as con:
-                try:
-                    inst_name = con.handshake()
-                    logging.info(f"-> [{ str(idx) }] { addr } { inst_name }\n")
-                    self.__handshakes[addr] = inst_name
-                except:
+        responded = dict()
+        for addr, inst_name in self.iter_handshakes():
+            responded[addr] = inst_name
+            with self.__lock:
+                self.__record(addr, inst_name)
+                self.__unverified.discard(addr)
+        if self.__cache is not None:
+            self.__cache.store(responded)
+
+    def rescan(self) -> None:
+        discovered = list(self.__resources.list_resources())
+        with self.__lock:
+            for addr in set(self.__handshakes.keys()).difference(discovered):
+                self.__evict(addr)
+            self.__discovered = discovered
+        self.get_handshakes()
+
+    """
+    Incremental update of the discovered resources: only addresses that were not listed
+    before are handshaked, vanished ones are evicted from the handshakes, the allocation
+    pool and the session pool. Listed addresses that failed their handshake (e.g. a busy
+    instrument) are retried every handshake_retry seconds. Returns the added { address:
+    *IDN? } and removed addresses.
+    """
+    def refresh(self, listed = None):
+        listed = list(self.__resources.list_resources()) if listed is None else list(listed)
+        now = monotonic()
+        with self.__lock:
+            new = [addr for addr in listed if addr not in self.__discovered]
+            retried = [addr for addr in listed if addr in self.__discovered and addr not in self.__handshakes
+                       and self.__retry_at.get(addr, 0) <= now]
+            vanished = [addr for addr in self.__discovered if addr not in listed]
+            for addr in vanished:
+                self.__evict(addr)
+                self.__retry_at.pop(addr, None)
+            self.__discovered = listed
+        added = dict()
+        for addr, inst_name in self.iter_handshakes(new + retried):
+            added[addr] = inst_name
+            with self.__lock:
+                self.__record(addr, inst_name)
+        with self.__lock:
+            for addr in new + retried:
+                if addr in added:
+                    self.__retry_at.pop(addr, None)
+                else:
+                    self.__retry_at[addr] = now + self.__handshake_retry
+        if self.__cache is not None and len(added) > 0:
+            self.__cache.store(added)
+        return added, vanished
+
+    def revalidate(self, addr) -> bool:
+        with self.__lock:
+            if addr not in self.__unverified:
+                return addr in self.__handshakes
+        inst_name = self.__probe(addr)
+        with self.__lock:
+            self.__unverified.discard(addr)
+            if inst_name is None:
+                logging.warning(f"-> Cached instrument at address { addr } did not respond")
+                self.__forget(addr)
+                return False
+            if inst_name != self.__handshakes.get(addr):
+                logging.info(f"-> Cached handshake of { addr } changed to { inst_name }")
+            self.__record(addr, inst_name)
+        if self.__cache is not None:
+            self.__cache.update(addr, inst_name)
+        return True
+
+    def __record(self, addr, inst_name):
+        self.__handshakes[addr] = inst_name
+        self.__registry.add(addr, inst_name)
+
+    def __evict(self, addr):
+        logging.info(f"-> Resource { addr } vanished")
+        self.__forget(addr)
+        if addr in self.__allocated:
+            self.__allocated.remove(addr)
+        self.__reserved.discard(addr)
+        self.__pool.evict(addr)
+
+    def __forget(self, addr):
+        self.__handshakes.pop(addr, None)
+        self.__registry.remove(addr)
+        self.__unverified.discard(addr)
+        if self.__cache is not None:
+            self.__cache.invalidate(addr)
+
+    """
+    Probes the addresses concurrently and yields (address, *IDN? response) pairs as they
+    complete. Every probe is bounded by probe_timeout [ms] and the whole pass by
+    discovery_budget [s]; addresses still pending after the budget are reported and skipped.
+    """
+    def iter_handshakes(self, addresses = None):
+        addresses = self.__discovered if addresses is None else list(addresses)
+        if len(addresses) == 0:
+            return
+        executor = ThreadPoolExecutor(max_workers = min(self.__max_workers, len(addresses)), thread_name_prefix = "handshake")
+        pending = { executor.submit(self.__probe, addr): addr for addr in addresses }
+        try:
+            for future in as_completed(pending, timeout = self.__discovery_budget):
+                addr = pending.pop(future)
+                idx = self.__discovered.index(addr) if addr in self.__discovered else -1
+                inst_name = future.result()
+                if inst_name is None:
                     logging.warning(f"[{ str(idx) }] { addr } DISCOVERED RESOURCE TIMED OUT\n")
+                    continue
+                logging.info(f"-> [{ str(idx) }] { addr } { inst_name }\n")
+                yield addr, inst_name
+        except TimeoutError:
+            for addr in pending.values():
+                logging.warning(f"{ addr } DISCOVERY BUDGET EXCEEDED\n")
+        finally:
+            executor.shutdown(wait = False, cancel_futures = True)
+
+    """
+    Sessions of addresses that timed out or are not instruments of a registered driver
+    are closed right after the probe, since ports (e.g. a Nucleo COM port opened by
+    pyserial) are exclusive and must not stay held by the pool
+    """
+    def __probe(self, addr):
+        idn = None
+        try:
+            with InstrumentConnection(addr, self.__resources, timeout = self.__probe_timeout, pool = self.__pool) as con:
+                idn = con.handshake()
+                return idn
+        except:
+            return None
+        finally:
+            if idn is None or DriverRegistry.identify(idn) is None:
+                self.__pool.evict_unused(addr)
 
     def get_instrument_address(self, idx):
         try:
@@ -72,16 +239,56 @@ class InstrumentDiscovery:
         except:
             logging.warning("-> Instrument was not found")
 
-    def allocate(self, instrument: Instrument, mode = "default", interactive = True):
-        if instrument.default_addresses != self.default_addresses:
-            self.__allocated = []
-            self.default_addresses = instrument.default_addresses
-        for addr in (addr for addr in self.default_addresses if (addr not in self.__allocated and addr in self.__handshakes)):
-            connection = InstrumentConnection(addr, self.__resources)
+    """
+    Allocates an instrument of the given driver class. A configured role is resolved
+    directly through the registry; otherwise the first free address whose *IDN? maps to
+    the driver is taken (falling back to the driver's default addresses). When none is
+    free, the resources are rescanned once, so instruments attached or swapped since the
+    discovery cache was written are found before giving up. Interactive confirmation is
+    only offered where a console key reader is available (Windows).
+    """
+    def allocate(self, instrument: Instrument, mode = "default", interactive = True, role = None):
+        if role is not None:
+            with self.__lock:
+                addr, driver = self.__registry.resolve_role(role)
+                known = addr is not None and addr in self.__handshakes
+            if known and self.revalidate(addr):
+                logging.info(f"-> Role { role } allocated at { addr }")
+                with self.__lock:
+                    self.__reserved.add(addr)
+                connection = InstrumentConnection(addr, self.__resources, pool = self.__pool)
+                return connection, (instrument if driver is None else driver)(connection, mode)
+            logging.warning(f"-> Role { role } is not configured or its instrument did not respond")
+        with self.__lock:
+            if instrument is not self.__allocating:
+                self.__allocated = []
+                self.__allocating = instrument
+                self.default_addresses = instrument.default_addresses
+        if interactive and getch is None:
+            logging.info("-> Interactive allocation is not available on this platform")
+            interactive = False
+        allocation = self.__allocate_free(instrument, mode, interactive)
+        if allocation is None:
+            logging.info("-> No free instrument found, rescanning the resources")
+            self.rescan()
+            allocation = self.__allocate_free(instrument, mode, interactive)
+        if allocation is None:
+            raise LookupError("Allocation ran out of the address pool")
+        return allocation
+
+    def __allocate_free(self, instrument: Instrument, mode, interactive):
+        with self.__lock:
+            candidates = self.__registry.addresses(instrument)
+            if len(candidates) == 0:
+                candidates = [addr for addr in self.default_addresses if addr in self.__handshakes]
+        for addr in candidates:
+            if not self.__is_free(addr) or not self.revalidate(addr):
+                continue
+            connection = InstrumentConnection(addr, self.__resources, pool = self.__pool)
             instrument_alloc: Instrument
             instrument_alloc = instrument(connection, mode)
             if not interactive:
-                self.__allocated.append(addr)
+                self.__take(addr)
                 return connection, instrument_alloc
             with connection, instrument_alloc:
                 print("\n\tOne instrument was switched to remote operation and was assigned a mode for present measurement")
@@ -91,7 +298,14 @@ class InstrumentDiscovery:
                 if usr_ctrl == b' ':
                     continue
                 else:
-                    self.__allocated.append(addr)
+                    self.__take(addr)
                     return connection, instrument_alloc
-        raise LookupError("Allocation ran out of the address pool")
-                
\ No newline at end of file
+        return None
+
+    def __is_free(self, addr):
+        with self.__lock:
+            return addr not in self.__allocated and addr not in self.__reserved
+
+    def __take(self, addr):
+        with self.__lock:
+            self.__allocated.append(addr)
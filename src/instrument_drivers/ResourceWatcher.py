@@ -0,0 +1,31 @@
+from src.instrument_drivers.InstrumentDiscovery import InstrumentDiscovery
+from src.instrument_drivers.BackgroundPoller import BackgroundPoller
+from enum import StrEnum
+import logging
+
+"""
+Background hot-plug watcher
+
+Periodically diffs the listed VISA resources against the discovery, handshakes only
+the new addresses, evicts the vanished ones and notifies the subscribers with
+callback(event, address, idn) where idn is None for removed resources.
+"""
+class ResourceWatcher(BackgroundPoller):
+    class Event(StrEnum):
+        Added = "added"
+        Removed = "removed"
+
+    def __init__(self, discovery: InstrumentDiscovery, interval = 2):
+        super().__init__("Resource watcher", interval)
+        self.__discovery = discovery
+
+    def poll(self):
+        added, removed = self.__discovery.refresh()
+        for addr in removed:
+            self.__notify(self.Event.Removed, addr, None)
+        for addr, inst_name in added.items():
+            self.__notify(self.Event.Added, addr, inst_name)
+
+    def __notify(self, event: Event, address, idn):
+        logging.info(f"-> Resource { address } { event }")
+        self._notify(event, address, idn)
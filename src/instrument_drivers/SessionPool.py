@@ -0,0 +1,149 @@
+from __future__ import annotations
+from pyvisa import ResourceManager
+from time import monotonic
+import threading
+import logging
+import atexit
+
+"""
+Process-wide pool of open VISA sessions keyed by resource address
+
+Sessions are reference counted; releasing the last reference keeps the session
+open for idle_timeout seconds so that a following script or discovery pass can
+reuse it without paying for open/configure/close again.
+"""
+class SessionPool:
+    __SHARED = None
+
+    class Session:
+        def __init__(self, resource):
+            self.resource = resource
+            self.references = 0
+            self.released_at = None
+            self.configuration = None
+            self.lock = threading.RLock()
+
+    def __init__(self, idle_timeout = 30):
+        self.__idle_timeout = idle_timeout
+        self.__resource_manager = None
+        self.__sessions: dict[str, SessionPool.Session] = dict()
+        self.__opening: dict[str, threading.Lock] = dict()
+        self.__lock = threading.RLock()
+
+    @classmethod
+    def shared(cls) -> SessionPool:
+        if cls.__SHARED is None:
+            cls.__SHARED = cls()
+            atexit.register(cls.__SHARED.close)
+        return cls.__SHARED
+
+    @property
+    def resource_manager(self):
+        with self.__lock:
+            if self.__resource_manager is None:
+                self.__resource_manager = ResourceManager()
+            return self.__resource_manager
+
+    @property
+    def idle_timeout(self):
+        return self.__idle_timeout
+
+    @idle_timeout.setter
+    def idle_timeout(self, timeout):
+        self.__idle_timeout = timeout
+
+    @property
+    def addresses(self):
+        return list(self.__sessions.keys())
+
+    def references(self, address):
+        session = self.__sessions.get(address)
+        return 0 if session is None else session.references
+
+    """
+    Opening a resource can take seconds (e.g. a serial device timing out), so it runs
+    outside the pool-wide lock; a per-address lock keeps two threads from opening the
+    same address twice while other addresses are acquired and released meanwhile
+    """
+    def acquire(self, address, handler: ResourceManager = None, **configuration) -> Session:
+        with self.__lock:
+            opening = self.__opening.setdefault(address, threading.Lock())
+        with opening:
+            with self.__lock:
+                session = self.__sessions.get(address)
+                if session is not None:
+                    return self.__reference(session, configuration)
+            handler = self.resource_manager if handler is None else handler
+            session = SessionPool.Session(handler.open_resource(address))
+            with self.__lock:
+                self.__sessions[address] = session
+                logging.debug(f"-> Session { address } opened")
+                return self.__reference(session, configuration)
+
+    """
+    A session in use keeps the configuration of its holders; e.g. a probe with a short
+    timeout must not shorten the timeout of a foreground connection reading a buffer
+    """
+    def __reference(self, session: Session, configuration):
+        if session.configuration != configuration and session.references == 0:
+            for attr, value in configuration.items():
+                setattr(session.resource, attr, value)
+            session.configuration = configuration
+        session.references += 1
+        session.released_at = None
+        return session
+
+    """
+    Given the acquired session, a release is ignored once that session was evicted, so
+    the holder of an evicted session never drops a reference of its successor
+    """
+    def release(self, address, session: Session = None):
+        with self.__lock:
+            current = self.__sessions.get(address)
+            if current is None or (session is not None and current is not session):
+                return
+            session = current
+            session.references = max(0, session.references - 1)
+            if session.references > 0:
+                return
+            session.released_at = monotonic()
+            if self.__idle_timeout is not None and self.__idle_timeout <= 0:
+                self.evict(address)
+                return
+        if self.__idle_timeout is not None:
+            reaper = threading.Timer(self.__idle_timeout, self.evict_idle)
+            reaper.daemon = True
+            reaper.start()
+
+    def evict_idle(self):
+        with self.__lock:
+            for address, session in list(self.__sessions.items()):
+                if session.references == 0 and session.released_at is not None and monotonic() - session.released_at >= self.__idle_timeout:
+                    self.evict(address)
+
+    def evict_unused(self, address):
+        with self.__lock:
+            session = self.__sessions.get(address)
+            if session is not None and session.references == 0:
+                self.evict(address)
+
+    def evict(self, address):
+        with self.__lock:
+            session = self.__sessions.pop(address, None)
+            if session is None:
+                return
+            if session.references > 0:
+                logging.warning(f"-> Session { address } evicted with { session.references } active references")
+            try:
+                session.resource.close()
+                logging.info(f"-> Session { address } closed")
+            except:
+                logging.warning(f"-> Session { address } could not be closed")
+
+    def close(self):
+        with self.__lock:
+            for address in list(self.__sessions.keys()):
+                self.evict(address)
+            if self.__resource_manager is not None:
+                self.__resource_manager.close()
+                self.__resource_manager = None
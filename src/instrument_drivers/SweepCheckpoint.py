@@ -0,0 +1,60 @@
+from pathlib import Path
+from time import time
+import logging
+import json
+from src.instrument_drivers.jsonfile import write_atomic
+
+"""
+Persistent progress of a running sweep
+
+Stores the sweep plan description, the number of completed points, the setpoints of
+the last completed point and the data file with the offset up to which it holds the
+completed points. The file is rewritten atomically, so an interrupted run always
+leaves a consistent checkpoint behind.
+"""
+class SweepCheckpoint:
+    VERSION = 1
+
+    def __init__(self, path):
+        self.__path = Path(path)
+
+    @classmethod
+    def for_data_file(cls, filename):
+        file_path = Path(filename)
+        return cls(file_path.parent.joinpath(file_path.stem + ".checkpoint.json"))
+
+    @staticmethod
+    def normalized(content):
+        return json.loads(json.dumps(content, default = lambda value: value.item() if hasattr(value, "item") else str(value)))
+
+    @property
+    def path(self):
+        return self.__path
+
+    @property
+    def exists(self):
+        return self.__path.exists()
+
+    def load(self):
+        try:
+            with self.__path.open("r") as checkpoint_file:
+                content = json.load(checkpoint_file)
+            if content.get("version") != self.VERSION:
+                return None
+            return content
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, AttributeError):
+            logging.warning(f"-> Sweep checkpoint { self.__path } is unreadable, ignoring it")
+            return None
+
+    def store(self, plan: dict, completed, setpoints, data_file, offset, header):
+        content = self.normalized(dict(version = self.VERSION, timestamp = time(), plan = plan, completed = completed,
+                                       setpoints = setpoints, data_file = str(data_file), offset = offset, header = header))
+        try:
+            write_atomic(self.__path, content)
+        except OSError:
+            logging.warning(f"-> Sweep checkpoint { self.__path } could not be written")
+
+    def clear(self):
+        self.__path.unlink(missing_ok = True)
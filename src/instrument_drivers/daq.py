@@ -2,11 +2,17 @@ from __future__ import annotations
 from datetime import datetime
 from pathlib import Path
 import csv
+import os
 import logging
 from enum import Enum, auto
 from src.instrument_drivers.InstrumentDiscovery import InstrumentDiscovery
 from src.instrument_drivers.DMM6500 import DMM6500
 from src.instrument_drivers.CPX400DP import CPX400DP
+from src.instrument_drivers.sweep import SweepPlan, AdaptiveSweep
+from src.instrument_drivers.SweepCheckpoint import SweepCheckpoint
+from src.instrument_drivers.pipeline import Pipeline
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
 import time
 import typing
 
@@ -16,11 +22,19 @@ Data acquisition composer class
 class DAQ:
     class Mode(Enum):
         Power = auto()
+        Sweep = auto()
+        Adaptive = auto()
+
+    class Sync(Enum):
+        Software = auto()
+        Hardware = auto()
+        External = auto()
 
     class Params:
-        def __init__(self, voltage_range: tuple[int, int] = (0, 24), current_range: tuple[int, int] = (0, 0.5)):
+        def __init__(self, voltage_range: tuple[int, int] = (0, 24), current_range: tuple[int, int] = (0, 0.5), sync = None):
             self.__v_range = voltage_range
             self.__i_range = current_range
+            self.__sync = DAQ.Sync.Software if sync is None else sync
 
         @property
         def current_range(self):
@@ -34,13 +48,90 @@ class DAQ:
         def voltage_range(self):
             return self.__v_range
 
+        @property
+        def sync(self):
+            return self.__sync
+
+    """
+    Samples several meters at the same moment
+
+    Sync.Software runs acquire_measurement of all meters concurrently, one worker thread
+    per meter. Sync.Hardware arms all meters, triggers the first one by *TRG and the
+    others by its EXT TRIG OUT pulse (wired to their EXT TRIG IN). Sync.External arms all
+    meters for a trigger pulse wired to every EXT TRIG IN. sample() returns the readings
+    by meter name and, for software sampling, the skew [s] between the meters as the
+    spread of the host-side sampling instants. Triggered sampling reports no skew (None):
+    relative timestamps start at every meter's own first reading and absolute ones
+    differ by the offset between the meter clocks, so neither shows the trigger latency.
+    """
+    class Sampler:
+        def __init__(self, meters: dict, sync = None, timeout = 10):
+            self.__meters = meters
+            self.__sync = DAQ.Sync.Software if sync is None else sync
+            self.__timeout = timeout
+            self.__executor = None
+            self.__index = 0
+
+        def __enter__(self):
+            self.__executor = ThreadPoolExecutor(max_workers = len(self.__meters), thread_name_prefix = "daq-sampler")
+            return self
+
+        def __exit__(self, except_type, except_val, except_trace):
+            if self.__sync != DAQ.Sync.Software:
+                for meter in self.__meters.values():
+                    meter.abort()
+            self.__executor.shutdown()
+            self.__executor = None
+
+        @property
+        def sync(self):
+            return self.__sync
+
+        def arm(self, points):
+            self.__index = 0
+            if self.__sync == DAQ.Sync.Software:
+                return
+            master, *slaves = self.__meters.values()
+            for meter in slaves:
+                meter.arm_triggered(points, DMM6500.Trigger.External)
+            if self.__sync == DAQ.Sync.Hardware:
+                master.arm_triggered(points, DMM6500.Trigger.Command, emit = True)
+            else:
+                master.arm_triggered(points, DMM6500.Trigger.External)
+
+        def sample(self):
+            if self.__sync == DAQ.Sync.Software:
+                results = self.__gather(self.__measure)
+            else:
+                self.__index += 1
+                if self.__sync == DAQ.Sync.Hardware:
+                    next(iter(self.__meters.values())).trigger()
+                results = self.__gather(lambda meter: meter.fetch(self.__index, self.__timeout))
+                return { name: value for name, (value, _) in results.items() }, None
+            instants = [instant for _, instant in results.values()]
+            return { name: value for name, (value, _) in results.items() }, max(instants) - min(instants)
+
+        def __gather(self, read):
+            futures = { name: self.__executor.submit(read, meter) for name, meter in self.__meters.items() }
+            return { name: future.result() for name, future in futures.items() }
+
+        @staticmethod
+        def __measure(meter: DMM6500):
+            start = time.monotonic()
+            value = meter.acquire_measurement()
+            return value, (start + time.monotonic()) / 2
+
     def __init__(self, discovery: InstrumentDiscovery):
         self.__discovery = discovery
 
-    def __call__(self, mode: typing.Optional[Mode], params: Params):
+    def __call__(self, mode: typing.Optional[Mode], params: Params | SweepPlan | AdaptiveSweep):
         match(mode):
             case self.Mode.Power:
                 self.power(params)
+            case self.Mode.Sweep:
+                self.sweep(params)
+            case self.Mode.Adaptive:
+                self.adaptive_sweep(params)
             case None:
                 pass
 
@@ -50,31 +141,136 @@ class DAQ:
     def __exit__(self, except_type, except_val, except_trace):
         return
 
-    def power(self, params: Params):
+    def power(self, params: Params, resume = False):
         ammeter: DMM6500
-        voltmeter_con, voltmeter = self.__discovery.allocate(DMM6500, DMM6500.Mode.DCVMeter)
+        voltmeter_con, voltmeter = self.__discovery.allocate(DMM6500, DMM6500.Mode.DCVMeter, role = "voltmeter")
         voltmeter: DMM6500
-        ammeter_con, ammeter = self.__discovery.allocate(DMM6500, DMM6500.Mode.DCAMeter)
+        ammeter_con, ammeter = self.__discovery.allocate(DMM6500, DMM6500.Mode.DCAMeter, role = "ammeter")
         src: CPX400DP
-        src_con, src = self.__discovery.allocate(CPX400DP, CPX400DP.Mode.Default, False)
+        src_con, src = self.__discovery.allocate(CPX400DP, "default", False, role = "supply")
+
+        def sample(setpoints):
+            readings, skew = sampler.sample()
+            return { "v": readings["v"], "i": readings["i"], "skew": skew }
 
-        volts = Series("v")
-        amps = Series("i")
-        watts = Series("p")
-        with voltmeter_con, ammeter_con, src_con, voltmeter, ammeter, src:
+        voltage = SweepPlan.Axis("v_set", [v / 10 for v in range(params.voltage_range[0] * 10, params.voltage_range[1] * 10 + 1)],
+                                 lambda value: src.set_voltage(1, value), SweepPlan.Settle(50e-3))
+        plan = SweepPlan([voltage], [SweepPlan.Measurement("power", sample)])
+        with voltmeter_con, ammeter_con, src_con, voltmeter, ammeter, src, DAQ.Sampler({ "v": voltmeter, "i": ammeter }, params.sync) as sampler:
             src.set_current(1, params.current_limit)
             src.set_voltage(1, params.voltage_range[0])
             src.out_on(1)
-            for v in range(params.voltage_range[0] * 10, params.voltage_range[1] * 10 + 1):
-                src.set_voltage(1, v / 10)
-                time.sleep(50e-3)
-                volt = voltmeter.acquire_measurement()
-                amp = ammeter.acquire_measurement()
-                volts.add_data_point(volt)
-                amps.add_data_point(amp)
-                watts.add_data_point(float(volt) * float(amp))
-        with SeriesWriter(r"./src/measurements/power.csv") as writer:
-            writer.write(volts + amps + watts)
+            sampler.arm(len(plan))
+            self.sweep(plan, r"./src/measurements/power.csv", resume = resume, derive = { "p": lambda row: row["v"] * row["i"] })
+
+    """
+    Runs a SweepPlan point by point, applying only the axes that changed, and streams
+    the setpoints with the measured values of every point to the data file. Every flush
+    of the file stores a checkpoint (plan, completed points, last setpoints, data file
+    offset) next to it; resume continues the sweep of the same plan after the last
+    stored point, applying all axes of its first point again so the instruments are
+    brought back to the stored setpoints rather than trusting any cached state.
+
+    The calling thread only applies setpoints and reads the instruments; the raw rows
+    are processed by a Pipeline of worker stages: parsing of numeric readings, derived
+    quantities (derive = { name: func(row) }), limit checks (limits = { name: (low,
+    high) }, violations logged and listed in a limits column) and storage. E.g.
+
+        plan = SweepPlan([
+            SweepPlan.Axis("v", np.arange(0, 24.1, 0.5), lambda v: src.set_voltage(1, v), SweepPlan.Settle(20e-3, per_unit = 5e-3)),
+            SweepPlan.Axis("i_lim", [0.1, 0.5], lambda i: src.set_current(1, i), SweepPlan.Settle(50e-3)),
+            SweepPlan.Axis("ch", ["1", "2"], lambda ch: meters.update(dmm = dmm(ch, DMM6500.Mode.DCVMeter)), cost = 20e-3),
+        ], [SweepPlan.Measurement("v_dut", lambda setpoints: meters["dmm"].acquire_measurement(), 30e-3)])
+    """
+    def sweep(self, plan: SweepPlan, filename = r"./src/measurements/sweep.csv", flush_interval = 5, flush_rows = 100, checkpoint = True, resume = False,
+              derive: dict = None, limits: dict = None, queue_size = 64):
+        store = SweepCheckpoint.for_data_file(filename)
+        saved = store.load() if resume else None
+        if resume and saved is None:
+            logging.warning(f"-> No checkpoint at { store.path }, starting the sweep from the first point")
+        if saved is not None and saved["plan"] != SweepCheckpoint.normalized(plan.describe()):
+            raise ValueError(f"Checkpoint { store.path } belongs to a different sweep plan")
+        start = 0 if saved is None else saved["completed"]
+        header = None if saved is None else saved["header"]
+        logging.info(f"-> Sweep of { len(plan) - start } points estimated to { sum(point.estimate for point in plan.schedule[start:]) :.1f} s, axis changes { plan.changes }")
+
+        def save(writer: SeriesWriter):
+            completed = start + writer.rows_flushed
+            if not checkpoint or header is None:
+                return
+            store.store(plan.describe(), completed, plan.schedule[completed - 1].setpoints if completed > 0 else None,
+                        writer.filename, writer.offset, header)
+
+        def parse(row):
+            return { name: DAQ.__parse(value) for name, value in row.items() }
+
+        def derive_quantities(row):
+            for name, func in derive.items():
+                row[name] = func(row)
+            return row
+
+        def check_limits(row):
+            violated = [name for name, (low, high) in limits.items() if row.get(name) is not None and not low <= row[name] <= high]
+            if len(violated) > 0:
+                logging.warning(f"-> Limits of { ', '.join(violated) } exceeded at { { name: row[name] for name in plan.columns } }")
+            row["limits"] = ",".join(violated)
+            return row
+
+        def write(row):
+            nonlocal header
+            if header is None:
+                header = list(row)
+                writer.write_header(header)
+            writer.append_row([row.get(name) for name in header])
+            return row
+
+        derive = dict() if derive is None else derive
+        limits = dict() if limits is None else limits
+        stages = [Pipeline.Stage("parse", parse, queue_size)]
+        if len(derive) > 0:
+            stages.append(Pipeline.Stage("derive", derive_quantities, queue_size))
+        if len(limits) > 0:
+            stages.append(Pipeline.Stage("limits", check_limits, queue_size))
+        stages.append(Pipeline.Stage("store", write, queue_size))
+
+        previous = None
+        with SeriesWriter(filename if saved is None else saved["data_file"], stream = True, flush_interval = flush_interval, flush_rows = flush_rows,
+                          on_flush = save, resume_offset = None if saved is None else saved["offset"]) as writer, Pipeline(stages) as pipeline:
+            for point in plan.schedule[start:]:
+                plan.apply(point, previous)
+                pipeline.put(plan.measure(point))
+                previous = point
+        store.clear()
+        return writer.filename
+
+    @staticmethod
+    def __parse(value):
+        if isinstance(value, str):
+            try:
+                return float(value)
+            except ValueError:
+                return value.strip()
+        return value
+
+    """
+    Runs an AdaptiveSweep, e.g. an IV curve refined where the current changes sharply
+
+        iv = AdaptiveSweep(SweepPlan.Axis("v", np.arange(0, 24.1, 2), lambda v: src.set_voltage(1, v), SweepPlan.Settle(50e-3)),
+                           [SweepPlan.Measurement("i", lambda setpoints: ammeter.acquire_measurement())], "i", resolution = 0.05)
+
+    and writes its points ordered by the axis value
+    """
+    def adaptive_sweep(self, sweep: AdaptiveSweep, filename = r"./src/measurements/adaptive.csv"):
+        rows = sweep.run()
+        if len(rows) == 0:
+            return None
+        series = { name: Series(name) for name in rows[0] }
+        for row in rows:
+            for name, value in row.items():
+                series[name].add_data_point(value)
+        with SeriesWriter(filename) as writer:
+            writer.write(reduce(lambda left, right: left + right, series.values()))
+        return series
     
 """ 
 Basic class for creating series of acquired data
@@ -135,31 +331,107 @@ class Series:
 
 """
 Class for writing data series to a file in csv format
+
+In stream mode the file is opened on entering the context and every row passed to
+append_row is written through a buffer flushed to disk (and synced) every
+flush_rows rows or flush_interval seconds, so memory stays flat and the data
+acquired so far survives a crash. on_flush(writer) is called after every flush and
+a stream given resume_offset continues an existing file, dropping whatever was
+written past that offset.
 """
 class SeriesWriter:
-        def __init__(self, filename, dry_run = False):
+        def __init__(self, filename, dry_run = False, stream = False, flush_interval = 5, flush_rows = 100, on_flush = None, resume_offset = None):
             self.__filename = filename
             self.__dry_run = dry_run
+            self.__stream = stream
+            self.__flush_interval = flush_interval
+            self.__flush_rows = flush_rows
+            self.__on_flush = on_flush
+            self.__resume_offset = resume_offset
             self.__writeable_series = []
+            self.__file = None
+            self.__csv_w = None
+            self.__rows_written = 0
+            self.__rows_pending = 0
+            self.__last_flush = time.monotonic()
             
         def __enter__(self):
             if self.__dry_run:
                 logging.debug("-> Preparing unique file name")
+            elif self.__stream and self.__resume_offset is not None:
+                self.__filename = Path(self.__filename)
+                self.__file = self.__filename.resolve().open("r+", newline='')
+                self.__file.truncate(self.__resume_offset)
+                self.__file.seek(self.__resume_offset)
+                self.__csv_w = csv.writer(self.__file, delimiter=";")
+                logging.info("-> Resuming report file " + str(self.__filename))
             elif self.__filename is not None:
                 file_path = Path(self.__filename)
                 self.__filename = file_path.parent.joinpath(file_path.stem + '_' + datetime.now().strftime("%d-%m-%Y_%H-%M-%S") + file_path.suffix)
+                if self.__stream:
+                    self.__file = self.__filename.resolve().open("w", newline='')
+                    self.__csv_w = csv.writer(self.__file, delimiter=";")
             return self
 
         def __exit__(self, except_type, except_val, except_trace):
             if self.__dry_run:
                 logging.debug("-> Creating data file")
                 return
+            if self.__stream:
+                self.flush()
+                self.__file.close()
+                self.__file = None
+                logging.info(f"-> Report file with { self.__rows_written } rows written at " + str(self.__filename))
+                return
             with self.__filename.resolve().open("w", newline='') as series_file:
                 csv_w = csv.writer(series_file, delimiter=";")
                 csv_w.writerows(self.__writeable_series)
             logging.info("-> Report file written at " + str(self.__filename))
 
+        @property
+        def filename(self):
+            return self.__filename
+
+        @property
+        def rows_written(self):
+            return self.__rows_written
+
+        @property
+        def rows_flushed(self):
+            return self.__rows_written - self.__rows_pending
+
+        @property
+        def offset(self):
+            return None if self.__file is None else self.__file.tell()
+
         def write(self, series: Series):
             self.__writeable_series.append(series.header)
             self.__writeable_series.extend(series.header_fields)
             self.__writeable_series.extend(series)
+            if self.__stream:
+                self.flush()
+
+        def write_header(self, header, header_fields = ()):
+            self.__writeable_series.append(list(header))
+            self.__writeable_series.extend(header_fields)
+            if self.__stream:
+                self.flush()
+
+        def append_row(self, row):
+            self.__writeable_series.append(list(row))
+            self.__rows_written += 1
+            self.__rows_pending += 1
+            if self.__stream and (len(self.__writeable_series) >= self.__flush_rows or time.monotonic() - self.__last_flush >= self.__flush_interval):
+                self.flush()
+
+        def flush(self):
+            self.__last_flush = time.monotonic()
+            if not self.__stream or self.__dry_run or self.__file is None:
+                return
+            self.__csv_w.writerows(self.__writeable_series)
+            self.__writeable_series = []
+            self.__rows_pending = 0
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+            if self.__on_flush is not None:
+                self.__on_flush(self)
@@ -10,7 +10,6 @@ class GUIController:
     @staticmethod
     def view_inst_select():
         ID = InstrumentDiscovery()
-        ID.get_handshakes()
         rcvd = ID.handshakes
         
         gc = GUIContent("inst_select_view")
@@ -0,0 +1,17 @@
+from pathlib import Path
+import json
+
+"""
+Atomic JSON file writes
+
+The content is dumped to a temporary file next to the target, which then replaces
+the target in one step, so a crashed or concurrently started script never reads a
+partial file. Raises OSError when the file cannot be written.
+"""
+def write_atomic(path, content):
+    path = Path(path)
+    path.parent.mkdir(parents = True, exist_ok = True)
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with tmp_path.open("w") as json_file:
+        json.dump(content, json_file, indent = 1)
+    tmp_path.replace(path)
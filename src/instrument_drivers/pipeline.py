@@ -0,0 +1,148 @@
+from __future__ import annotations
+from time import monotonic
+import threading
+import logging
+import queue
+
+"""
+Producer/consumer processing pipeline
+
+The producer (e.g. the acquisition loop, which then only talks to the instruments)
+puts items into the first stage. Every stage runs its function on its own worker
+thread and passes the result on to the next stage through a bounded queue; a stage
+function returning None drops the item. Full queues block the stage before them, so a
+slow consumer throttles the producer instead of growing memory. Closing the pipeline
+drains every queued item, and the first stage error is raised in the producer.
+
+Every stage counts the processed items, the time spent processing them (throughput
+is items per busy second) and the time its producers were blocked putting items into
+it, i.e. the back-pressure it exerted.
+"""
+class Pipeline:
+    __END = object()
+
+    class Stage:
+        def __init__(self, name, func, maxsize = 64):
+            self.__name = name
+            self.__func = func
+            self.__queue = queue.Queue(maxsize)
+            self.__processed = 0
+            self.__busy = 0
+            self.__blocked = 0
+            self.__high_water = 0
+
+        @property
+        def name(self):
+            return self.__name
+
+        @property
+        def queue(self):
+            return self.__queue
+
+        @property
+        def processed(self):
+            return self.__processed
+
+        @property
+        def busy(self):
+            return self.__busy
+
+        @property
+        def blocked(self):
+            return self.__blocked
+
+        @property
+        def high_water(self):
+            return self.__high_water
+
+        @property
+        def throughput(self):
+            return self.__processed / self.__busy if self.__busy > 0 else 0.0
+
+        def put(self, item):
+            start = monotonic()
+            self.__queue.put(item)
+            self.__blocked += monotonic() - start
+            self.__high_water = max(self.__high_water, self.__queue.qsize())
+
+        def process(self, item):
+            start = monotonic()
+            result = self.__func(item)
+            self.__busy += monotonic() - start
+            self.__processed += 1
+            return result
+
+    def __init__(self, stages: list[Stage]):
+        self.__stages = list(stages)
+        self.__threads = []
+        self.__error = None
+        self.__produced = 0
+        self.__started = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, except_type, except_val, except_trace):
+        self.close(raise_error = except_type is None)
+
+    @property
+    def stages(self):
+        return self.__stages
+
+    @property
+    def produced(self):
+        return self.__produced
+
+    @property
+    def stats(self):
+        elapsed = monotonic() - self.__started if self.__started is not None else 0
+        return { stage.name: dict(processed = stage.processed, busy = stage.busy, throughput = stage.throughput,
+                                  rate = stage.processed / elapsed if elapsed > 0 else 0, blocked = stage.blocked,
+                                  high_water = stage.high_water) for stage in self.__stages }
+
+    def start(self):
+        self.__started = monotonic()
+        self.__error = None
+        self.__threads = [threading.Thread(target = self.__run, args = (idx,), name = f"pipeline-{ stage.name }", daemon = True)
+                          for idx, stage in enumerate(self.__stages)]
+        for thread in self.__threads:
+            thread.start()
+
+    def put(self, item):
+        if self.__error is not None:
+            raise self.__error
+        self.__stages[0].put(item)
+        self.__produced += 1
+
+    def close(self, raise_error = True):
+        if len(self.__threads) == 0:
+            return
+        self.__stages[0].put(self.__END)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+        for name, stats in self.stats.items():
+            logging.info(f"-> Stage { name }: { stats['processed'] } items, { stats['throughput'] :.1f}/s when busy, back-pressure { stats['blocked'] :.2f} s, queue peak { stats['high_water'] }")
+        if raise_error and self.__error is not None:
+            raise self.__error
+
+    def __run(self, idx):
+        stage = self.__stages[idx]
+        following = self.__stages[idx + 1] if idx + 1 < len(self.__stages) else None
+        while True:
+            item = stage.queue.get()
+            if item is self.__END:
+                if following is not None:
+                    following.put(self.__END)
+                return
+            if self.__error is not None:
+                continue
+            try:
+                result = stage.process(item)
+            except Exception as e:
+                logging.error(f"-> Pipeline stage { stage.name } failed: { e }")
+                self.__error = e
+                continue
+            if result is not None and following is not None:
+                following.put(result)
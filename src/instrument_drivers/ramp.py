@@ -0,0 +1,144 @@
+from __future__ import annotations
+from time import sleep, monotonic
+import numpy as np
+
+"""
+Deadline-scheduled setpoint profiles
+
+A Ramp is a list of setpoints with the time each of them is due, relative to the
+start of the ramp. Ramp.run applies the setpoints against absolute deadlines of a
+monotonic clock, so time lost in one step (communication, pacing) is absorbed by the
+following waits instead of accumulating, and reports the achieved timing per step.
+"""
+class Ramp:
+    RESOLUTION = 4
+
+    """
+    Achieved timing of a finished ramp; due and applied are relative to the ramp start [s]
+    """
+    class Report:
+        def __init__(self, setpoints, due, applied, completed):
+            self.__setpoints = setpoints
+            self.__due = np.asarray(due)
+            self.__applied = np.asarray(applied)
+            self.__completed = np.asarray(completed)
+
+        def __len__(self):
+            return len(self.__due)
+
+        @property
+        def setpoints(self):
+            return self.__setpoints
+
+        @property
+        def due(self):
+            return self.__due
+
+        @property
+        def applied(self):
+            return self.__applied
+
+        @property
+        def lateness(self):
+            return self.__applied - self.__due
+
+        @property
+        def max_lateness(self):
+            return float(self.lateness.max()) if len(self) > 0 else 0.0
+
+        @property
+        def command_time(self):
+            return self.__completed - self.__applied
+
+        @property
+        def duration(self):
+            return float(self.__completed[-1]) if len(self) > 0 else 0.0
+
+    def __init__(self, setpoints, due):
+        self.__setpoints = np.round(np.asarray(setpoints, dtype = float), self.RESOLUTION)
+        self.__due = np.asarray(due, dtype = float)
+        if len(self.__setpoints) != len(self.__due):
+            raise ValueError("Every setpoint needs a due time")
+
+    def __len__(self):
+        return len(self.__setpoints)
+
+    def __iter__(self):
+        return zip(self.__setpoints, self.__due)
+
+    def __add__(self, ramp: Ramp):
+        offset = self.duration + (ramp.due[1] - ramp.due[0] if len(ramp) > 1 else 0)
+        return Ramp(np.concatenate([self.__setpoints, ramp.setpoints]), np.concatenate([self.__due, ramp.due + offset]))
+
+    @property
+    def setpoints(self):
+        return self.__setpoints
+
+    @property
+    def due(self):
+        return self.__due
+
+    @property
+    def duration(self):
+        return float(self.__due[-1]) if len(self) > 0 else 0.0
+
+    @staticmethod
+    def __count(start, stop, step):
+        if not step > 0:
+            raise ValueError(f"Ramp step must be positive, got { step }")
+        return int(round(abs(stop - start) / step)) + 1
+
+    """
+    With slew_rate the dwell follows from the actual spacing of the points, which
+    differs from step when it does not divide the span
+    """
+    @staticmethod
+    def __dwell(start, stop, count, dwell, slew_rate):
+        if slew_rate is None:
+            return dwell
+        if not slew_rate > 0:
+            raise ValueError(f"Ramp slew rate must be positive, got { slew_rate }")
+        return abs(stop - start) / max(count - 1, 1) / slew_rate
+
+    @classmethod
+    def custom(cls, setpoints, dwell):
+        setpoints = np.asarray(setpoints, dtype = float)
+        return cls(setpoints, np.arange(len(setpoints)) * dwell)
+
+    @classmethod
+    def linear(cls, start, stop, step = 0.1, dwell = 50e-3, slew_rate = None):
+        count = cls.__count(start, stop, step)
+        return cls.custom(np.linspace(start, stop, count), cls.__dwell(start, stop, count, dwell, slew_rate))
+
+    @classmethod
+    def triangle(cls, start, peak, step = 0.1, dwell = 50e-3, slew_rate = None):
+        count = cls.__count(start, peak, step)
+        rising = np.linspace(start, peak, count)
+        return cls.custom(np.concatenate([rising, rising[-2::-1]]), cls.__dwell(start, peak, count, dwell, slew_rate))
+
+    @classmethod
+    def staircase(cls, levels, hold):
+        return cls.custom(levels, hold)
+
+    """
+    Merges ramps of single channels into one ramp with a row of setpoints per due time,
+    every channel holding its last setpoint until its next one is due
+    """
+    @classmethod
+    def combine(cls, *ramps: Ramp):
+        due = np.unique(np.concatenate([ramp.due for ramp in ramps]))
+        columns = [ramp.setpoints[np.clip(np.searchsorted(ramp.due, due, side = "right") - 1, 0, None)] for ramp in ramps]
+        return cls(np.column_stack(columns), due)
+
+    def run(self, apply) -> Report:
+        applied = []
+        completed = []
+        start = monotonic()
+        for setpoint, due in self:
+            remaining = start + due - monotonic()
+            if remaining > 0:
+                sleep(remaining)
+            applied.append(monotonic() - start)
+            apply(setpoint.item() if np.ndim(setpoint) == 0 else setpoint)
+            completed.append(monotonic() - start)
+        return Ramp.Report(self.__setpoints, self.__due, applied, completed)
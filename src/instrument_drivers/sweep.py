@@ -0,0 +1,325 @@
+from __future__ import annotations
+from time import sleep, monotonic
+import logging
+
+"""
+Declarative multi-axis sweep plans
+
+A SweepPlan nests axes (e.g. supply voltage x current limit x DMM channel), each of
+them applying its setpoints through a callable and settling by its own rule, and a set
+of measurements taken at every point. The full schedule is computed up front, so the
+number of points, the operations they involve and the expected duration are known
+before anything is sent to the instruments.
+
+Axes are ordered so the most expensive changes (relay switching, output toggling,
+slow slewing) happen least often: the axis with the highest expected time per change
+becomes the outermost loop. With serpentine ordering the inner axes run back and
+forth instead of jumping back to their first value whenever an outer axis advances.
+"""
+class SweepPlan:
+    """
+    Settling after an axis changed: a fixed delay [s] plus per_unit [s] per unit of
+    setpoint change, optionally followed by polling until(setpoints) up to timeout [s]
+    """
+    class Settle:
+        def __init__(self, fixed = 0, per_unit = 0, until = None, timeout = 5, poll_interval = 20e-3):
+            self.__fixed = fixed
+            self.__per_unit = per_unit
+            self.__until = until
+            self.__timeout = timeout
+            self.__poll_interval = poll_interval
+
+        def estimate(self, previous, value):
+            if self.__per_unit == 0 or previous is None:
+                return self.__fixed
+            try:
+                return self.__fixed + self.__per_unit * abs(value - previous)
+            except TypeError:
+                return self.__fixed
+
+        def poll(self, setpoints):
+            if self.__until is None:
+                return True
+            deadline = monotonic() + self.__timeout
+            while not self.__until(setpoints):
+                if monotonic() > deadline:
+                    logging.warning(f"-> Sweep point { setpoints } did not settle in { self.__timeout } s")
+                    return False
+                sleep(self.__poll_interval)
+            return True
+
+    """
+    Swept quantity; apply(value) sets it and cost [s] is the expected time of one change
+    """
+    class Axis:
+        def __init__(self, name, values, apply, settle: SweepPlan.Settle = None, cost = 0):
+            self.__name = name
+            self.__values = list(values)
+            self.__apply = apply
+            self.__settle = SweepPlan.Settle() if settle is None else settle
+            self.__cost = cost
+
+        def __len__(self):
+            return len(self.__values)
+
+        @property
+        def name(self):
+            return self.__name
+
+        @property
+        def values(self):
+            return self.__values
+
+        @property
+        def settle(self):
+            return self.__settle
+
+        @property
+        def cost(self):
+            return self.__cost
+
+        """
+        Expected time [s] of one change: the cost plus the settling averaged over the
+        steps between consecutive values, so per_unit slew counts with the real step size
+        """
+        @property
+        def change_time(self):
+            steps = [self.__settle.estimate(previous, value) for previous, value in zip(self.__values, self.__values[1:])]
+            return self.__cost + (sum(steps) / len(steps) if len(steps) > 0 else self.__settle.estimate(None, None))
+
+        def apply(self, value):
+            self.__apply(value)
+
+    """
+    Measurement taken at every point; read(setpoints) returns a value (stored as name)
+    or a dict of named values, duration [s] is its expected time
+    """
+    class Measurement:
+        def __init__(self, name, read, duration = 0):
+            self.__name = name
+            self.__read = read
+            self.__duration = duration
+
+        @property
+        def name(self):
+            return self.__name
+
+        @property
+        def duration(self):
+            return self.__duration
+
+        def read(self, setpoints):
+            values = self.__read(setpoints)
+            return values if isinstance(values, dict) else { self.__name: values }
+
+    class Point:
+        def __init__(self, index, setpoints: dict, changed: tuple, estimate):
+            self.__index = index
+            self.__setpoints = setpoints
+            self.__changed = changed
+            self.__estimate = estimate
+
+        @property
+        def index(self):
+            return self.__index
+
+        @property
+        def setpoints(self):
+            return self.__setpoints
+
+        @property
+        def changed(self):
+            return self.__changed
+
+        @property
+        def estimate(self):
+            return self.__estimate
+
+        def __repr__(self):
+            return f"Point({ self.index }, { self.setpoints }, changed = { self.changed })"
+
+    def __init__(self, axes: list, measurements: list, order = "cost", serpentine = True):
+        self.__declared = list(axes)
+        self.__axes = sorted(axes, key = lambda axis: axis.change_time, reverse = True) if order == "cost" else list(axes)
+        self.__measurements = list(measurements)
+        self.__serpentine = serpentine
+        self.__schedule = None
+
+    def __len__(self):
+        return len(self.schedule)
+
+    def __iter__(self):
+        return iter(self.schedule)
+
+    @property
+    def axes(self):
+        return self.__axes
+
+    @property
+    def measurements(self):
+        return self.__measurements
+
+    @property
+    def columns(self):
+        return [axis.name for axis in self.__declared]
+
+    @property
+    def schedule(self) -> list[Point]:
+        if self.__schedule is None:
+            self.__schedule = self.__build()
+        return self.__schedule
+
+    @property
+    def estimate(self):
+        return sum(point.estimate for point in self.schedule)
+
+    @property
+    def changes(self):
+        return { axis.name: sum(1 for point in self.schedule if axis.name in point.changed) for axis in self.__axes }
+
+    def __walk(self):
+        passes = [0] * len(self.__axes)
+        def walk(depth):
+            axis = self.__axes[depth]
+            values = axis.values
+            if self.__serpentine and passes[depth] % 2 == 1:
+                values = values[::-1]
+            passes[depth] += 1
+            for value in values:
+                if depth == len(self.__axes) - 1:
+                    yield (value,)
+                else:
+                    for tail in walk(depth + 1):
+                        yield (value,) + tail
+        if len(self.__axes) == 0:
+            return iter([()])
+        return walk(0)
+
+    def __build(self):
+        measure_time = sum(measurement.duration for measurement in self.__measurements)
+        schedule = []
+        previous = [None] * len(self.__axes)
+        for index, values in enumerate(self.__walk()):
+            changed = tuple(axis.name for axis, value, last in zip(self.__axes, values, previous) if value != last)
+            settle = max([axis.settle.estimate(last, value) for axis, value, last in zip(self.__axes, values, previous) if value != last], default = 0)
+            cost = sum(axis.cost for axis, value, last in zip(self.__axes, values, previous) if value != last)
+            setpoints = { axis.name: value for axis, value in zip(self.__axes, values) }
+            schedule.append(SweepPlan.Point(index, { name: setpoints[name] for name in self.columns }, changed, cost + settle + measure_time))
+            previous = list(values)
+        return schedule
+
+    def describe(self):
+        return dict(axes = [dict(name = axis.name, values = axis.values) for axis in self.__axes],
+                    measurements = [measurement.name for measurement in self.__measurements],
+                    serpentine = self.__serpentine)
+
+    def axis(self, name) -> Axis:
+        return next(axis for axis in self.__axes if axis.name == name)
+
+    """
+    Applies the changed axes of a point (all of them without a previous point, outermost
+    first), waits for the longest settling delay among them and then polls their
+    settling conditions
+    """
+    def apply(self, point: Point, previous: Point = None):
+        changed = [axis for axis in self.__axes if previous is None or axis.name in point.changed]
+        delay = 0
+        for axis in changed:
+            axis.apply(point.setpoints[axis.name])
+            last = None if previous is None else previous.setpoints[axis.name]
+            delay = max(delay, axis.settle.estimate(last, point.setpoints[axis.name]))
+        if delay > 0:
+            sleep(delay)
+        return all([axis.settle.poll(point.setpoints) for axis in changed])
+
+    def measure(self, point: Point):
+        row = dict(point.setpoints)
+        for measurement in self.__measurements:
+            row.update(measurement.read(point.setpoints))
+        return row
+
+"""
+Adaptive one-axis sweep
+
+Measures the axis values as a coarse grid and then, pass by pass, bisects every
+interval in which the watched quantity changes by more than max_change or crosses
+threshold, until the intervals are narrower than resolution. Without a criterion the
+change limit defaults to a tenth of the span of the quantity over the coarse grid.
+Every pass visits its new points in alternating direction to keep the setpoint jumps
+short; since the points are not visited monotonically, quantities with hysteresis need
+one adaptive sweep per direction.
+"""
+class AdaptiveSweep:
+    def __init__(self, axis: SweepPlan.Axis, measurements: list, quantity, resolution, max_change = None, threshold = None, max_points = 1000):
+        self.__axis = axis
+        self.__measurements = list(measurements)
+        self.__quantity = quantity
+        self.__resolution = resolution
+        self.__max_change = max_change
+        self.__threshold = threshold
+        self.__max_points = max_points
+        self.__rows = dict()
+        self.__last = None
+
+    def __len__(self):
+        return len(self.__rows)
+
+    @property
+    def axis(self):
+        return self.__axis
+
+    @property
+    def rows(self):
+        return [self.__rows[value] for value in sorted(self.__rows)]
+
+    @property
+    def uniform_points(self):
+        values = self.__axis.values
+        return int(round((max(values) - min(values)) / self.__resolution)) + 1
+
+    def run(self, on_row = None):
+        self.__rows = dict()
+        self.__last = None
+        pending = sorted(self.__axis.values)
+        descending = False
+        while len(pending) > 0:
+            for value in (reversed(pending) if descending else pending):
+                if len(self.__rows) >= self.__max_points:
+                    logging.warning(f"-> Adaptive sweep stopped at { self.__max_points } points")
+                    return self.rows
+                row = self.__measure(value)
+                if on_row is not None:
+                    on_row(row)
+            descending = not descending
+            pending = self.__refinements()
+        logging.info(f"-> Adaptive sweep took { len(self) } points instead of { self.uniform_points }")
+        return self.rows
+
+    def __measure(self, value):
+        self.__axis.apply(value)
+        delay = self.__axis.settle.estimate(self.__last, value)
+        if delay > 0:
+            sleep(delay)
+        row = { self.__axis.name: value }
+        self.__axis.settle.poll(dict(row))
+        for measurement in self.__measurements:
+            row.update(measurement.read(dict(row)))
+        self.__rows[value] = row
+        self.__last = value
+        return row
+
+    def __refinements(self):
+        values = sorted(self.__rows)
+        quantities = [float(self.__rows[value][self.__quantity]) for value in values]
+        max_change = self.__max_change
+        if max_change is None and self.__threshold is None:
+            max_change = (max(quantities) - min(quantities)) / 10
+        refinements = []
+        for (left, right), (q_left, q_right) in zip(zip(values, values[1:]), zip(quantities, quantities[1:])):
+            if right - left <= self.__resolution:
+                continue
+            sharp = max_change is not None and abs(q_right - q_left) > max_change
+            crossing = self.__threshold is not None and q_left != q_right and (q_left - self.__threshold) * (q_right - self.__threshold) <= 0
+            if sharp or crossing:
+                refinements.append(round(left + (right - left) / 2, 9))
+        return refinements
@@ -56,17 +56,14 @@ def ips8200hq_out16a1_uvlo_convex_ramp(init_hold_time, final_hold_time, log_leve
 
     src_handle = ContextGuard(InstrumentConnection(ID.next_default_address, ID.connection_handler))
     with src_handle, CPX400DP(src_handle.evaluate()) as src:
-        src.set_voltage(1, 12)
-        src.set_voltage(2, 3.3)
+        src.set_voltages({1: 12, 2: 3.3})
         time.sleep(10)
-        src.out_on(1)
-        src.out_on(2)
+        src.outs_on()
         time.sleep(5 if init_hold_time < 5 else init_hold_time)
         src.ramp_voltage(1, 12, 5)
         src.ramp_voltage(1, 5, 12)
         time.sleep(5 if final_hold_time < 5 else final_hold_time)
-        src.out_off(2)
-        src.out_off(1)
+        src.outs_off()
 
 """
 Helper function for determination of UVLO function voltage thresholds
@@ -79,17 +76,14 @@ def ips8200hq_out16a1_uvlo_concave_ramp(init_hold_time, final_hold_time, log_lev
 
     src_handle = ContextGuard(InstrumentConnection(ID.next_default_address, ID.connection_handler))
     with src_handle, CPX400DP(src_handle.evaluate()) as src:
-        src.set_voltage(1, 5)
-        src.set_voltage(2, 3.3)
+        src.set_voltages({1: 5, 2: 3.3})
         time.sleep(10)
-        src.out_on(1)
-        src.out_on(2)
+        src.outs_on()
         time.sleep(5 if init_hold_time < 5 else init_hold_time)
         src.ramp_voltage(1, 5, 12)
         src.ramp_voltage(1, 12, 5)
         time.sleep(5 if final_hold_time < 5 else final_hold_time)
-        src.out_off(2)
-        src.out_off(1)
+        src.outs_off()
 
 """
 Helper function for determination of IN pin logic voltage thresholds
@@ -102,17 +96,14 @@ def ips8200hq_out16a1_input_convex_ramp(init_hold_time, final_hold_time, log_lev
 
     src_handle = ContextGuard(InstrumentConnection(ID.next_default_address, ID.connection_handler))
     with src_handle, CPX400DP(src_handle.evaluate()) as src:
-        src.set_voltage(1, 24)
-        src.set_voltage(2, 5)
+        src.set_voltages({1: 24, 2: 5})
         time.sleep(10)
-        src.out_on(1)
-        src.out_on(2)
+        src.outs_on()
         time.sleep(5 if init_hold_time < 5 else init_hold_time)
         src.ramp_voltage(2, 5, 0)
         src.ramp_voltage(2, 0, 5)
         time.sleep(5 if final_hold_time < 5 else final_hold_time)
-        src.out_off(2)
-        src.out_off(1)
+        src.outs_off()
 
 """
 Helper function for determination of IN pin logic voltage thresholds
@@ -125,14 +116,11 @@ def ips8200hq_out16a1_input_concave_ramp(init_hold_time, final_hold_time, log_le
 
     src_handle = ContextGuard(InstrumentConnection(ID.next_default_address, ID.connection_handler))
     with src_handle, CPX400DP(src_handle.evaluate()) as src:
-        src.set_voltage(1, 24)
-        src.set_voltage(2, 0)
+        src.set_voltages({1: 24, 2: 0})
         time.sleep(10)
-        src.out_on(1)
-        src.out_on(2)
+        src.outs_on()
         time.sleep(5 if init_hold_time < 5 else init_hold_time)
         src.ramp_voltage(2, 0, 5)
         src.ramp_voltage(2, 5, 0)
         time.sleep(5 if final_hold_time < 5 else final_hold_time)
-        src.out_off(2)
-        src.out_off(1)
+        src.outs_off()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The drivers are imported as src.instrument_drivers, relative to the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,94 @@
+import pytest
+
+from src.instrument_drivers.InstrumentConnection import InstrumentConnection
+from src.instrument_drivers.SessionPool import SessionPool
+
+
+class Resource:
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def query(self, line, delay = None):
+        self.lines.append(line)
+        return "1"
+
+    def close(self):
+        pass
+
+
+class Handler:
+    def __init__(self):
+        self.resource = Resource()
+
+    def open_resource(self, address):
+        return self.resource
+
+
+@pytest.fixture
+def connection():
+    handler = Handler()
+    with InstrumentConnection("TCPIP::instrument::INSTR", handler, pool = SessionPool(idle_timeout = 0)) as connection:
+        connection.lines = handler.resource.lines
+        yield connection
+
+
+def test_batch_is_written_as_one_line(connection):
+    with connection.batch():
+        connection.send("VOLT 1")
+        connection.send("CURR 2")
+        assert connection.lines == []
+    assert connection.lines == ["VOLT 1;CURR 2"]
+
+
+def test_batch_is_split_at_max_line_length(connection):
+    connection.max_line_length = 12
+    with connection.batch():
+        for cmd in ("V1 1", "V2 2", "V3 3"):
+            connection.send(cmd)
+    assert connection.lines == ["V1 1;V2 2", "V3 3"]
+
+
+def test_rooted_commands_are_prefixed_except_common_commands(connection):
+    connection.rooted_commands = True
+    with connection.batch():
+        connection.send("SENS:FUNC 'VOLT'")
+        connection.send("*CLS")
+        connection.send(":TRIG:CONT REST")
+    assert connection.lines == ["SENS:FUNC 'VOLT';*CLS;:TRIG:CONT REST"]
+
+
+def test_opc_suffix_counts_against_max_line_length(connection):
+    connection.pacing = InstrumentConnection.Pacing(sync = InstrumentConnection.Pacing.Sync.OPC)
+    connection.max_line_length = 14
+    with connection.batch():
+        connection.send("V1 1")
+        connection.send("V2 2")
+    assert connection.lines == ["V1 1;*OPC?", "V2 2;*OPC?"]
+
+
+def test_query_flushes_pending_commands_first(connection):
+    with connection.batch():
+        connection.send("VOLT 1")
+        connection.send_query("VOLT?", 0)
+        connection.send("CURR 2")
+    assert connection.lines == ["VOLT 1", "VOLT?", "CURR 2"]
+
+
+def test_overlapped_command_is_written_alone_without_opc(connection):
+    connection.pacing = InstrumentConnection.Pacing(sync = InstrumentConnection.Pacing.Sync.OPC)
+    with connection.batch():
+        connection.send("*RST")
+        connection.send("INIT", overlapped = True)
+    assert connection.lines == ["*RST;*OPC?", "INIT"]
+
+
+def test_failed_batch_discards_its_commands(connection):
+    with pytest.raises(RuntimeError):
+        with connection.batch():
+            connection.send("VOLT 1")
+            raise RuntimeError()
+    connection.flush()
+    assert connection.lines == []
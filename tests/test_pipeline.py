@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+
+from src.instrument_drivers.pipeline import Pipeline
+
+
+def test_items_pass_every_stage_in_order():
+    stored = []
+    stages = [Pipeline.Stage("double", lambda item: item * 2), Pipeline.Stage("store", stored.append)]
+    with Pipeline(stages) as pipeline:
+        for item in range(100):
+            pipeline.put(item)
+    assert stored == [item * 2 for item in range(100)]
+    assert pipeline.produced == 100
+    assert pipeline.stats["store"]["processed"] == 100
+
+
+def test_stage_returning_none_drops_the_item():
+    stored = []
+    stages = [Pipeline.Stage("odd", lambda item: item if item % 2 else None), Pipeline.Stage("store", stored.append)]
+    with Pipeline(stages) as pipeline:
+        for item in range(10):
+            pipeline.put(item)
+    assert stored == [1, 3, 5, 7, 9]
+
+
+def test_full_queue_blocks_the_producer():
+    release = threading.Event()
+    pipeline = Pipeline([Pipeline.Stage("slow", lambda item: release.wait(), maxsize = 2)])
+    pipeline.start()
+    producer = threading.Thread(target = lambda: [pipeline.put(item) for item in range(5)])
+    producer.start()
+    producer.join(0.2)
+    assert producer.is_alive()
+    assert pipeline.produced < 5
+    release.set()
+    producer.join()
+    pipeline.close()
+    assert pipeline.produced == 5
+    assert pipeline.stats["slow"]["blocked"] > 0
+
+
+def test_stage_error_is_raised_in_the_producer():
+    def fail(item):
+        raise ValueError(item)
+    with pytest.raises(ValueError):
+        with Pipeline([Pipeline.Stage("fail", fail)]) as pipeline:
+            pipeline.put(1)
+
+
+def test_stage_error_is_not_raised_over_the_producer_error():
+    def fail(item):
+        raise ValueError(item)
+    with pytest.raises(KeyError):
+        with Pipeline([Pipeline.Stage("fail", fail)]) as pipeline:
+            pipeline.put(1)
+            raise KeyError()
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from src.instrument_drivers.ramp import Ramp
+
+
+def test_linear_spans_start_to_stop_at_dwell():
+    ramp = Ramp.linear(0, 1, 0.25, dwell = 0.1)
+    assert list(ramp.setpoints) == [0, 0.25, 0.5, 0.75, 1]
+    assert np.allclose(ramp.due, [0, 0.1, 0.2, 0.3, 0.4])
+
+
+def test_linear_ramps_down():
+    assert list(Ramp.linear(1, 0, 0.5).setpoints) == [1, 0.5, 0]
+
+
+def test_triangle_returns_to_start():
+    assert list(Ramp.triangle(0, 1, 0.5).setpoints) == [0, 0.5, 1, 0.5, 0]
+
+
+def test_slew_rate_follows_the_actual_point_spacing():
+    ramp = Ramp.linear(0, 1, 0.3, slew_rate = 1)
+    slopes = np.diff(ramp.setpoints) / np.diff(ramp.due)
+    assert np.allclose(slopes, 1, atol = 1e-3)
+    assert ramp.duration == pytest.approx(1)
+
+
+@pytest.mark.parametrize("step", [0, -0.1, float("nan")])
+def test_non_positive_step_is_rejected(step):
+    with pytest.raises(ValueError):
+        Ramp.linear(0, 1, step)
+    with pytest.raises(ValueError):
+        Ramp.triangle(0, 1, step)
+
+
+@pytest.mark.parametrize("slew_rate", [0, -1])
+def test_non_positive_slew_rate_is_rejected(slew_rate):
+    with pytest.raises(ValueError):
+        Ramp.linear(0, 1, 0.1, slew_rate = slew_rate)
+
+
+def test_combine_holds_the_last_setpoint_of_every_channel():
+    ramp = Ramp.combine(Ramp.custom([0, 1, 2], 1), Ramp.custom([5, 6], 2))
+    assert list(ramp.due) == [0, 1, 2]
+    assert ramp.setpoints.tolist() == [[0, 5], [1, 5], [2, 6]]
+
+
+def test_run_applies_every_setpoint_in_order():
+    applied = []
+    report = Ramp.custom([1, 2, 3], 0).run(applied.append)
+    assert applied == [1, 2, 3]
+    assert len(report) == 3 and report.max_lateness >= 0
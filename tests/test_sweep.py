@@ -0,0 +1,32 @@
+from src.instrument_drivers.sweep import SweepPlan, AdaptiveSweep
+
+
+def adaptive_sweep(profile, **kwargs):
+    setpoint = dict()
+    axis = SweepPlan.Axis("v", [value * 2 for value in range(13)], lambda value: setpoint.update(v = value))
+    measurement = SweepPlan.Measurement("q", lambda setpoints: profile(setpoint["v"]))
+    sweep = AdaptiveSweep(axis, [measurement], "q", **kwargs)
+    sweep.run()
+    return sweep
+
+
+def test_plateau_at_threshold_is_not_refined():
+    sweep = adaptive_sweep(lambda v: 0.5 if 4 <= v <= 20 else 0.0, resolution = 0.01, threshold = 0.5)
+    refined = [row["v"] for row in sweep.rows if 4 < row["v"] < 20]
+    assert refined == [6, 8, 10, 12, 14, 16, 18]
+
+
+def test_threshold_crossing_is_refined_to_resolution():
+    sweep = adaptive_sweep(lambda v: 1.0 if v > 13.3 else 0.0, resolution = 0.01, threshold = 0.5)
+    crossing = [row["v"] for row in sweep.rows if 12 < row["v"] < 14]
+    below = max(v for v in crossing if v <= 13.3)
+    above = min(v for v in crossing if v > 13.3)
+    assert above - below <= 0.01
+
+
+def test_slewing_axis_is_ordered_by_its_real_steps():
+    supply = SweepPlan.Axis("v", [0, 10, 20, 30], lambda value: None, SweepPlan.Settle(10e-3, per_unit = 20e-3))
+    channel = SweepPlan.Axis("ch", ["1", "2"], lambda value: None, cost = 50e-3)
+    plan = SweepPlan([channel, supply], [])
+    assert [axis.name for axis in plan.axes] == ["v", "ch"]
+    assert plan.changes == { "v": 4, "ch": 5 }